@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+import openai
+from openai import AsyncOpenAI, OpenAI
+from rate_limiter import CircuitOpenError, ConcurrencyController
+from single_flight import SingleFlight
+from tracing import current_span, span
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+# API配置，可通过环境变量（或.env文件）覆盖
+API_KEY = os.getenv("OPENAI_API_KEY", "***")
+BASE_URL = os.getenv("OPENAI_BASE_URL", "***")
+MODEL = os.getenv("OPENAI_MODEL", "***")
+
+# 超时（秒）和重试策略
+REQUEST_TIMEOUT = float(os.getenv("AI_REQUEST_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "10"))
+MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "3"))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+# 可以重试的临时性错误
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,   # 包括超时
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+# 预估的每次回复token数，加上提示词字数作为每分钟token预算的预估用量
+ESTIMATED_COMPLETION_TOKENS = 256
+
+# 所有AI调用共用的限流器（自适应并发上限、每分钟预算、熔断）
+limiter = ConcurrencyController()
+
+# 相同请求（模型和规范化后的消息相同）同时只发送一次，其余调用共享结果；
+# 设置AI_SINGLE_FLIGHT=0关闭，AI_SINGLE_FLIGHT_CROSS_PROCESS=1同时合并不同进程中的相同请求
+SINGLE_FLIGHT = os.getenv("AI_SINGLE_FLIGHT", "1") != "0"
+single_flight = SingleFlight(cross_process=os.getenv("AI_SINGLE_FLIGHT_CROSS_PROCESS", "0") == "1")
+
+# 最近的调用记录（耗时、重试次数等）
+CALL_HISTORY_SIZE = 1000
+call_history = deque(maxlen=CALL_HISTORY_SIZE)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# 异步客户端与事件循环绑定，每个事件循环各用一个
+_async_clients = weakref.WeakKeyDictionary()
+
+def _timeout():
+    return openai.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+def get_client():
+    """
+    获取共享的API客户端
+
+    首次调用时创建，之后复用同一个连接池（keep-alive），避免每次请求重新建立连接和TLS握手。
+    子进程中会重新创建，不与父进程共用连接。
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = OpenAI(
+                api_key=API_KEY,
+                base_url=BASE_URL,
+                max_retries=0,  # 重试由chat_completion统一处理
+                timeout=_timeout(),
+            )
+            _client_pid = os.getpid()
+        return _client
+
+def get_async_client():
+    """获取当前事件循环共享的异步API客户端，首次调用时创建"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=API_KEY,
+            base_url=BASE_URL,
+            max_retries=0,  # 重试由achat_completion统一处理
+            timeout=_timeout(),
+        )
+        _async_clients[loop] = client
+    return client
+
+def backoff_delay(attempt):
+    """第attempt次重试前的等待时间：指数退避加全随机抖动"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+def _collect_stream(response):
+    """收集流式响应的完整内容"""
+    content = ""
+    for chunk in response:
+        if chunk.choices and getattr(chunk.choices[0].delta, 'content', None) is not None:
+            content += chunk.choices[0].delta.content
+    return content
+
+def _record_call(label, started, retries, error=None, usage=None):
+    """记录一次调用的耗时、重试次数和token用量"""
+    record = {
+        "label": label,
+        "latency": time.perf_counter() - started,
+        "retries": retries,
+        "ok": error is None,
+        "error": type(error).__name__ if error is not None else None,
+        "prompt_tokens": getattr(usage, 'prompt_tokens', None),
+        "completion_tokens": getattr(usage, 'completion_tokens', None),
+    }
+    call_history.append(record)
+    current_span().set(retries=retries, prompt_tokens=record["prompt_tokens"],
+                       completion_tokens=record["completion_tokens"])
+    return record
+
+def estimate_tokens(messages):
+    """粗略估计一次请求的token数（中文约每字一个token），用于每分钟token预算"""
+    return sum(len(str(m.get("content", ""))) for m in messages) + ESTIMATED_COMPLETION_TOKENS
+
+def _release(started, tokens, usage=None, error=None):
+    """
+    归还限流器名额，按结果调整并发上限和熔断状态
+
+    只有接口的响应（成功、过载类错误或接口返回的其他错误）才影响并发上限和熔断状态；
+    任务被取消和本地错误没有得到接口的响应，只归还名额。
+    """
+    extra_tokens = 0
+    if getattr(usage, 'total_tokens', None):
+        extra_tokens = usage.total_tokens - tokens
+    overloaded = isinstance(error, RETRYABLE_ERRORS)
+    neutral = error is not None and not overloaded and not isinstance(error, openai.APIStatusError)
+    limiter.release(time.perf_counter() - started, ok=error is None, overloaded=overloaded,
+                    extra_tokens=extra_tokens, neutral=neutral)
+
+def request_key(messages, model=None, **kwargs):
+    """相同请求的合并键：模型、规范化（合并空白）后的消息和其他请求参数的哈希"""
+    normalized = [{"role": m.get("role"), "content": " ".join(str(m.get("content", "")).split())}
+                  for m in messages]
+    payload = json.dumps([model or MODEL, normalized, kwargs], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def chat_completion(messages, model=None, stream=False, label="chat", max_retries=None, coalesce=True, **kwargs):
+    """
+    发送一次对话请求并返回回复内容
+
+    每次请求先从共享限流器取得名额（并发上限、每分钟预算、熔断）。
+    临时性错误（连接错误、超时、限流、服务端错误）按指数退避加随机抖动重试，
+    重试用尽后抛出最后一次的异常；熔断期间直接抛出CircuitOpenError。
+    每次调用的耗时和重试次数记录在call_history中。
+
+    参数：
+        messages：对话消息列表
+        model：模型名称，默认为MODEL
+        stream：是否使用流式响应
+        label：调用类型，用于统计
+        max_retries：最大重试次数，默认为MAX_RETRIES
+        coalesce：是否与同时进行的相同请求合并（需要多次独立回答时设为False）
+    """
+    if coalesce and SINGLE_FLIGHT:
+        return single_flight.do(
+            request_key(messages, model, **kwargs),
+            lambda: _chat_completion(messages, model, stream, label, max_retries, **kwargs))
+    return _chat_completion(messages, model, stream, label, max_retries, **kwargs)
+
+def _chat_completion(messages, model, stream, label, max_retries, **kwargs):
+    """chat_completion的实际请求部分（不合并）"""
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    tokens = estimate_tokens(messages)
+    with span(f"ai.{label}", model=model or MODEL, stream=stream, estimated_tokens=tokens):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                limiter.acquire(tokens)
+            except CircuitOpenError as e:
+                _record_call(label, started, attempt, error=e)
+                raise
+            attempt_started = time.perf_counter()
+            try:
+                response = get_client().chat.completions.create(
+                    model=model or MODEL,
+                    messages=messages,
+                    stream=stream,
+                    **kwargs
+                )
+                if stream:
+                    content, usage = _collect_stream(response), None
+                else:
+                    content, usage = response.choices[0].message.content, response.usage
+            except RETRYABLE_ERRORS as e:
+                _release(attempt_started, tokens, error=e)
+                if attempt >= max_retries:
+                    _record_call(label, started, attempt, error=e)
+                    raise
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            except Exception as e:
+                _release(attempt_started, tokens, error=e)
+                _record_call(label, started, attempt, error=e)
+                raise
+            _release(attempt_started, tokens, usage=usage)
+            _record_call(label, started, attempt, usage=usage)
+            return content
+
+async def _acollect_stream(response):
+    """收集异步流式响应的完整内容"""
+    content = ""
+    async for chunk in response:
+        if chunk.choices and getattr(chunk.choices[0].delta, 'content', None) is not None:
+            content += chunk.choices[0].delta.content
+    return content
+
+async def achat_completion(messages, model=None, stream=False, label="chat", max_retries=None, coalesce=True,
+                           **kwargs):
+    """chat_completion的异步版本，限流、重试、合并和统计方式相同"""
+    if coalesce and SINGLE_FLIGHT:
+        return await single_flight.ado(
+            request_key(messages, model, **kwargs),
+            lambda: _achat_completion(messages, model, stream, label, max_retries, **kwargs))
+    return await _achat_completion(messages, model, stream, label, max_retries, **kwargs)
+
+async def _achat_completion(messages, model, stream, label, max_retries, **kwargs):
+    """achat_completion的实际请求部分（不合并）"""
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    tokens = estimate_tokens(messages)
+    with span(f"ai.{label}", model=model or MODEL, stream=stream, estimated_tokens=tokens):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                await limiter.aacquire(tokens)
+            except CircuitOpenError as e:
+                _record_call(label, started, attempt, error=e)
+                raise
+            attempt_started = time.perf_counter()
+            try:
+                response = await get_async_client().chat.completions.create(
+                    model=model or MODEL,
+                    messages=messages,
+                    stream=stream,
+                    **kwargs
+                )
+                if stream:
+                    content, usage = await _acollect_stream(response), None
+                else:
+                    content, usage = response.choices[0].message.content, response.usage
+            except RETRYABLE_ERRORS as e:
+                _release(attempt_started, tokens, error=e)
+                if attempt >= max_retries:
+                    _record_call(label, started, attempt, error=e)
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            except BaseException as e:
+                # 包括任务被取消，名额必须归还
+                _release(attempt_started, tokens, error=e)
+                _record_call(label, started, attempt, error=e)
+                raise
+            _release(attempt_started, tokens, usage=usage)
+            _record_call(label, started, attempt, usage=usage)
+            return content
+
+def get_call_stats(label=None):
+    """汇总最近调用的次数、失败数、平均耗时、重试次数，以及被合并（未实际发送）的请求数"""
+    records = [r for r in call_history if label is None or r["label"] == label]
+    if not records:
+        return {"calls": 0, "failures": 0, "avg_latency": 0.0, "max_latency": 0.0, "retries": 0,
+                "coalesced": single_flight.coalesced}
+    latencies = [r["latency"] for r in records]
+    return {
+        "calls": len(records),
+        "failures": sum(1 for r in records if not r["ok"]),
+        "avg_latency": sum(latencies) / len(latencies),
+        "max_latency": max(latencies),
+        "retries": sum(r["retries"] for r in records),
+        "coalesced": single_flight.coalesced,
+    }
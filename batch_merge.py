@@ -0,0 +1,175 @@
+"""
+批量合并：在目录树中查找所有任务配置文件（默认为merge_job.json），用进程池并行执行
+
+- 进程数默认为CPU核数，每个进程在处理多个任务时复用同一组缓存（内存中的映射缓存不必重新加载）
+- 所有进程共用同一个映射缓存（SQLite）和值缓存（加锁合并写入）
+- 每个任务的输出写入配置文件旁的merge_job.log
+- 每完成一个任务就更新状态文件，程序中断后重新运行会跳过已成功且配置未修改的任务
+
+使用方法：
+    python batch_merge.py 班级目录 --workers 8
+    python batch_merge.py 班级目录 --rerun    # 忽略状态文件，全部重新执行
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+from mapping_cache import MappingCache
+from value_cache import ValueCache
+
+SPEC_NAME = 'merge_job.json'
+STATE_FILE = 'batch_state.json'
+LOG_NAME = 'merge_job.log'
+
+# 每个工作进程的缓存，由_init_worker创建，在该进程处理的所有任务之间复用
+_worker_caches = None
+
+def find_jobs(root, spec_name=SPEC_NAME):
+    """查找目录树中的所有任务配置文件，按路径排序"""
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if spec_name in filenames:
+            jobs.append(os.path.abspath(os.path.join(dirpath, spec_name)))
+    return sorted(jobs)
+
+def load_state(state_file):
+    """读取状态文件，不存在或损坏时返回空状态"""
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state_file, state):
+    """保存状态文件（先写入临时文件再原子替换，中断时不会留下不完整的文件）"""
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, state_file)
+
+def _spec_mtime(spec_path):
+    try:
+        return os.path.getmtime(spec_path)
+    except OSError:
+        return None
+
+def pending_jobs(jobs, state):
+    """跳过上次已成功且配置文件未修改的任务"""
+    return [job for job in jobs
+            if state.get(job, {}).get('status') != 'done' or state[job].get('spec_mtime') != _spec_mtime(job)]
+
+def _init_worker(mapping_cache_file, value_cache_file):
+    """工作进程初始化：创建该进程共用的缓存，任务内的来源解析和缩略图生成不再嵌套创建进程池"""
+    global _worker_caches
+    from merge_engine import LOAD_THREADS_ENV
+    os.environ[LOAD_THREADS_ENV] = '1'
+    _worker_caches = (MappingCache(cache_file=mapping_cache_file), ValueCache(cache_file=value_cache_file))
+
+def run_job(spec_path, use_async=True, consensus=False):
+    """
+    在工作进程中执行一个任务，输出写入配置文件旁的日志
+
+    返回：
+        任务结果字典（status为done或failed）
+    """
+    from merge_engine import load_job_spec, run_merge_job
+
+    cache, value_cache = _worker_caches or (MappingCache(), ValueCache())
+    log_path = os.path.join(os.path.dirname(spec_path), LOG_NAME)
+    started = time.perf_counter()
+    result = {'spec_mtime': _spec_mtime(spec_path), 'pid': os.getpid(), 'log': log_path}
+    with open(log_path, 'w', encoding='utf-8') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            output_path = run_merge_job(load_job_spec(spec_path), use_async=use_async, consensus=consensus,
+                                        cache=cache, value_cache=value_cache)
+            if output_path:
+                result.update(status='done', output=output_path)
+            else:
+                result.update(status='failed', error='获取列映射关系失败')
+        except Exception as e:
+            traceback.print_exc()
+            result.update(status='failed', error=f"{type(e).__name__}: {e}")
+    result['duration'] = time.perf_counter() - started
+    result['finished'] = datetime.now().isoformat(timespec='seconds')
+    return result
+
+def run_batch(root, workers=None, state_file=None, spec_name=SPEC_NAME, rerun=False, use_async=True,
+              consensus=False, mapping_cache_file='header_mappings_cache.db',
+              value_cache_file='value_normalization_cache.json'):
+    """
+    批量执行目录树中的所有任务
+
+    参数：
+        root：查找任务配置文件的根目录
+        workers：进程数，默认为CPU核数
+        state_file：状态文件，默认为根目录下的batch_state.json
+        rerun：是否忽略状态文件重新执行所有任务
+        mapping_cache_file/value_cache_file：所有进程共用的缓存文件
+
+    返回：
+        状态字典（任务配置路径 -> 结果）
+    """
+    state_file = state_file or os.path.join(root, STATE_FILE)
+    state = {} if rerun else load_state(state_file)
+    jobs = find_jobs(root, spec_name)
+    todo = pending_jobs(jobs, state)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(todo) or 1))
+    print(f"找到{len(jobs)}个任务，跳过{len(jobs) - len(todo)}个已完成的任务，使用{workers}个进程执行{len(todo)}个任务")
+
+    started = time.time()
+    cache_files = (os.path.abspath(mapping_cache_file), os.path.abspath(value_cache_file))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=cache_files) as executor:
+        futures = {executor.submit(run_job, job, use_async, consensus): job for job in todo}
+        for done_count, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # 工作进程异常退出（如内存不足被终止）
+                result = {'status': 'failed', 'error': f"{type(e).__name__}: {e}", 'spec_mtime': _spec_mtime(job),
+                          'finished': datetime.now().isoformat(timespec='seconds')}
+            state[job] = result
+            save_state(state_file, state)
+            mark = '完成' if result['status'] == 'done' else f"失败：{result.get('error')}"
+            print(f"[{done_count}/{len(todo)}] {os.path.relpath(job, root)} {mark}"
+                  f"（{result.get('duration', 0):.1f}秒）")
+
+    print_summary(jobs, state, time.time() - started)
+    return state
+
+def print_summary(jobs, state, elapsed):
+    """输出批量执行的汇总"""
+    results = [state.get(job, {}) for job in jobs]
+    done = sum(1 for r in results if r.get('status') == 'done')
+    failed = [job for job, r in zip(jobs, results) if r.get('status') == 'failed']
+    durations = [r['duration'] for r in results if 'duration' in r]
+    print("\n=== 批量合并汇总 ===")
+    print(f"任务总数：{len(jobs)}，成功：{done}，失败：{len(failed)}")
+    print(f"本次耗时：{elapsed:.1f}秒")
+    if durations:
+        print(f"单个任务平均耗时：{sum(durations) / len(durations):.1f}秒，最长：{max(durations):.1f}秒")
+    for job in failed:
+        print(f"失败：{job}\n  {state[job].get('error')}（日志：{state[job].get('log')}）")
+
+def main():
+    parser = argparse.ArgumentParser(description='批量执行目录树中的合并任务')
+    parser.add_argument('root', help='查找任务配置文件的根目录')
+    parser.add_argument('--workers', type=int, default=None, help='进程数，默认为CPU核数')
+    parser.add_argument('--state', default=None, help='状态文件，默认为根目录下的batch_state.json')
+    parser.add_argument('--spec-name', default=SPEC_NAME, help='任务配置文件名')
+    parser.add_argument('--rerun', action='store_true', help='忽略状态文件，重新执行所有任务')
+    parser.add_argument('--sync', action='store_true', help='任务内依次处理各来源（不并发）')
+    parser.add_argument('--consensus', action='store_true', help='使用共识模式获取映射关系')
+    args = parser.parse_args()
+    state = run_batch(args.root, args.workers, args.state, args.spec_name, args.rerun,
+                      use_async=not args.sync, consensus=args.consensus)
+    if any(result.get('status') != 'done' for result in state.values()):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+合并流程的端到端基准测试
+
+生成1千、10万、100万行的合成表1/表2/表3（表头写法、日期格式、学号和签名图片都模拟真实数据），
+AI调用由本进程内的模拟接口（mock_server.py）回答。合并由merge_engine.run_merge_job执行（与实际使用的代码相同），
+各阶段的耗时和内存峰值来自tracing记录的span，并可与保存的基线结果比较，发现性能回退。
+
+使用方法：
+    python benchmark.py --sizes 1000 100000
+    python benchmark.py --save-baseline            # 将本次结果保存为基线
+    python benchmark.py --baseline benchmark_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+import openpyxl
+import ai_client
+import input_cache
+import tracing
+from mock_server import MockConfig, start_server
+from mapping_cache import MappingCache
+from value_cache import ValueCache
+from merge_engine import run_merge_job
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+WORK_DIR = 'benchmark_data'
+RESULTS_FILE = 'benchmark_results.json'
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# 耗时超过基线的该比例，且绝对差值超过REGRESSION_MIN_SECONDS时判定为回退
+REGRESSION_TOLERANCE = 0.2
+REGRESSION_MIN_SECONDS = 0.05
+
+# 最多为多少名学生生成签名图片，其余学生的签名列留空
+SIGNATURE_IMAGE_LIMIT = 200
+
+# 结果表中的阶段（tracing中的span名称）；images为写出时的签名图片处理，包含在write中
+STAGES = ['read', 'map', 'date', 'join', 'sort', 'images', 'write']
+
+# 合成数据：表1为模板，表2为问卷导出（表头写法随机），表3为教务数据
+TITLE = 'xx班xx假期离返校去向表'
+HEADERS1 = ['序号', '姓名', '学号', '联系电话', '家长电话', '离校时间', '返校时间', '去向', '宿舍', '签名']
+HEADER2_VARIANTS = [
+    ['提交时间'],
+    ['请输入你的学号（必填）'],
+    ['你的名字', '姓名', '学生姓名'],
+    ['手机号', '联系电话', '本人电话'],
+    ['离校时间', '离校日期', '出发时间'],
+    ['返校时间', '返校日期', '回校时间'],
+    ['去向', '假期去向', '目的地'],
+    ['本人签名', '签名', '学生签名'],
+]
+HEADERS3 = ['学号', '姓名', '性别', '班级', '宿舍号', '家长联系电话']
+SURNAMES = '王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗'
+GIVEN_NAMES = '伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华'
+DESTINATIONS = ['北京市', '上海市', '广州市', '成都市', '武汉市', '西安市', '南京市', '杭州市', '留校']
+UNPARSEABLE_DATES = ['待定', '下周一', '考完试就走', '未知']
+
+def _random_date(rng, start):
+    """生成一个日期单元格，写法在常见格式、Excel日期和少量无法解析的文本之间随机"""
+    day = start + timedelta(days=rng.randrange(60))
+    kind = rng.random()
+    if kind < 0.02:
+        return rng.choice(UNPARSEABLE_DATES)
+    if kind < 0.3:
+        return day
+    if kind < 0.5:
+        return f"{day.month}月{day.day}日"
+    if kind < 0.7:
+        return f"{day.year}/{day.month}/{day.day}"
+    if kind < 0.85:
+        return day.strftime('%Y-%m-%d')
+    return f"{day.month}.{day.day}"
+
+def _write_workbook(path, rows, title=None):
+    """以只写模式写出工作簿，title不为None时第一行写标题"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    if title is not None:
+        ws.append([title])
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+
+def _write_signature_image(path):
+    """生成一张模拟的手写签名图片"""
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (400, 120), 'white')
+    ImageDraw.Draw(img).line([(20, 90), (150, 30), (260, 80), (380, 40)], fill='black', width=6)
+    img.save(path)
+
+def generate_tables(n_rows, out_dir, seed=0):
+    """
+    生成n_rows行的合成表1/表2/表3和签名图片，已存在时直接复用
+
+    返回：
+        {'file1', 'file2', 'file3', 'image_dir'} 路径字典
+    """
+    data_dir = os.path.join(out_dir, f'rows_{n_rows}')
+    paths = {
+        'file1': os.path.join(data_dir, 'table1.xlsx'),
+        'file2': os.path.join(data_dir, 'table2.xlsx'),
+        'file3': os.path.join(data_dir, 'table3.xlsx'),
+        'image_dir': os.path.join(data_dir, 'signatures'),
+    }
+    if all(os.path.exists(p) for p in paths.values()):
+        return paths
+    os.makedirs(paths['image_dir'], exist_ok=True)
+    rng = random.Random(seed + n_rows)
+    print(f"生成{n_rows}行的合成数据...")
+
+    ids = [str(2021000000 + i) for i in range(n_rows)]
+    names = [rng.choice(SURNAMES) + ''.join(rng.choice(GIVEN_NAMES) for _ in range(rng.randint(1, 2)))
+             for _ in range(n_rows)]
+    signed = set(rng.sample(range(n_rows), min(SIGNATURE_IMAGE_LIMIT, n_rows)))
+    start = datetime(2025, 1, 5)
+
+    # 表1：只有标题行和表头的模板
+    _write_workbook(paths['file1'], [HEADERS1], title=TITLE)
+
+    # 表2：问卷导出，表头写法随机，行顺序打乱
+    headers2 = [rng.choice(variants) for variants in HEADER2_VARIANTS]
+    order = list(range(n_rows))
+    rng.shuffle(order)
+
+    def table2_rows():
+        yield headers2
+        for i in order:
+            leave = _random_date(rng, start)
+            back = _random_date(rng, start + timedelta(days=30))
+            yield [start + timedelta(minutes=i), ids[i], names[i], f"1{rng.randrange(3, 10)}{rng.randrange(10**9):09d}",
+                   leave, back, rng.choice(DESTINATIONS), ids[i] if i in signed else None]
+    _write_workbook(paths['file2'], table2_rows())
+
+    # 表3：教务数据，学号为数字，约5%的学生不在表2中，少量重复行
+    def table3_rows():
+        yield HEADERS3
+        for i in range(n_rows):
+            student_id = int(ids[i]) if rng.random() > 0.05 else 2031000000 + i
+            row = [student_id, names[i], rng.choice('男女'), f"{rng.randrange(1, 10)}班",
+                   f"{rng.randrange(1, 20)}-{rng.randrange(101, 640)}", f"1{rng.randrange(3, 10)}{rng.randrange(10**9):09d}"]
+            yield row
+            if rng.random() < 0.001:
+                yield row
+    _write_workbook(paths['file3'], table3_rows(), title='教务原始数据')
+
+    # 签名图片：文件名包含学号
+    for i in signed:
+        _write_signature_image(os.path.join(paths['image_dir'], f"{ids[i]}_{names[i]}.png"))
+    return paths
+
+def _covered_time(intervals):
+    """区间并集的总长度：并发执行的同名span（如同时读取的各来源）重叠部分只计一次"""
+    total, end = 0.0, None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+def summarize_spans(records, stages=STAGES):
+    """
+    按span名称汇总跟踪记录
+
+    返回：
+        {阶段: {'time', 'spans', 'peak_rss_mb', 'rss_delta_mb'}}。time为该阶段的span覆盖的时间，
+        内存为各span峰值的最大值（无法获取当前内存时为process_peak_rss_mb，即进程启动以来的峰值）
+    """
+    summary = {}
+    for name in stages:
+        spans = [r for r in records if r['name'] == name]
+        if not spans:
+            continue
+        stage = {'time': _covered_time((r['start'], r['start'] + r['duration']) for r in spans), 'spans': len(spans)}
+        if all('peak_rss_mb' in r for r in spans):
+            stage['peak_rss_mb'] = max(r['peak_rss_mb'] for r in spans)
+            stage['rss_delta_mb'] = stage['peak_rss_mb'] - min(r['rss_start_mb'] for r in spans)
+        elif any('process_peak_rss_mb' in r for r in spans):
+            stage['process_peak_rss_mb'] = max(r.get('process_peak_rss_mb', 0) for r in spans)
+        summary[name] = stage
+    return summary
+
+def run_merge_stages(paths, work_dir):
+    """
+    用merge_engine.run_merge_job执行合并，从跟踪记录得到每个阶段的耗时和内存峰值
+
+    各来源的读取、映射和日期格式化与实际运行一样同时进行；不使用解析缓存，read阶段测量Excel解析本身。
+    """
+    trace_path = os.path.join(work_dir, 'trace.jsonl')
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    job = {
+        'template': {'path': paths['file1'], 'header_row': 1},
+        'sources': [
+            {'path': paths['file2'], 'key': '请输入你的学号（必填）'},
+            {'path': paths['file3'], 'header_row': 1},
+        ],
+        'image_dir': paths['image_dir'],
+        'output_dir': work_dir,
+    }
+    cache = MappingCache(cache_file=os.path.join(work_dir, 'mappings.db'))
+    value_cache = ValueCache(cache_file=os.path.join(work_dir, 'values.json'))
+
+    cache_dir = input_cache.CACHE_DIR
+    input_cache.CACHE_DIR = ''
+    tracing.configure(trace_path, 'jsonl')
+    try:
+        output_path = run_merge_job(job, cache=cache, value_cache=value_cache)
+    finally:
+        tracing.configure(None)
+        input_cache.CACHE_DIR = cache_dir
+    if output_path is None:
+        raise RuntimeError("获取列映射关系失败")
+
+    # 只统计本进程的span（来源较大时在进程池中解析，子进程不记录span）
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        records = [r for r in map(json.loads, f) if r['pid'] == os.getpid()]
+    stages = summarize_spans(records)
+    for name, stage in stages.items():
+        if 'peak_rss_mb' in stage:
+            memory = f"  峰值内存{stage['peak_rss_mb']:9.1f}MB"
+        elif 'process_peak_rss_mb' in stage:
+            memory = f"  进程峰值内存{stage['process_peak_rss_mb']:9.1f}MB"
+        else:
+            memory = ''
+        print(f"  {name:<8}{stage['time']:9.3f}秒{memory}")
+    return stages
+
+def compare_with_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE, min_seconds=REGRESSION_MIN_SECONDS):
+    """与基线逐阶段比较耗时，返回回退列表 [(行数, 阶段, 基线耗时, 本次耗时)]"""
+    regressions = []
+    for size, result in results['sizes'].items():
+        base_stages = baseline.get('sizes', {}).get(size, {}).get('stages', {})
+        for name, data in result['stages'].items():
+            base = base_stages.get(name)
+            if base is None:
+                continue
+            ratio = data['time'] / base['time'] if base['time'] else float('inf')
+            flag = ''
+            if data['time'] > base['time'] * (1 + tolerance) and data['time'] - base['time'] > min_seconds:
+                regressions.append((size, name, base['time'], data['time']))
+                flag = '  <-- 回退'
+            print(f"{size:>8}行 {name:<8}{base['time']:9.3f} -> {data['time']:9.3f}秒 ({ratio:5.2f}x){flag}")
+    return regressions
+
+def run_benchmark(sizes=DEFAULT_SIZES, work_dir=WORK_DIR, mock_latency=0.0, seed=0):
+    """生成数据并运行各规模的基准测试，返回结果字典"""
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    server, ai_client.BASE_URL = start_server(MockConfig(latency_mean=mock_latency, seed=seed))
+    ai_client.API_KEY = ai_client.MODEL = 'mock'
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mock_latency': mock_latency,
+        'sizes': {},
+    }
+    cwd = os.getcwd()
+    try:
+        for n_rows in sizes:
+            paths = generate_tables(n_rows, work_dir, seed)
+            run_dir = os.path.join(work_dir, f'run_{n_rows}')
+            os.makedirs(run_dir, exist_ok=True)
+            for name in os.listdir(run_dir):
+                path = os.path.join(run_dir, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+            # 签名索引、缩略图等使用当前目录的缓存，每个规模在单独的目录中运行
+            os.chdir(run_dir)
+            print(f"\n=== {n_rows}行 ===")
+            calls_before = ai_client.get_call_stats()['calls']
+            started = time.perf_counter()
+            stages = run_merge_stages(paths, run_dir)
+            results['sizes'][str(n_rows)] = {
+                'stages': stages,
+                'total_time': time.perf_counter() - started,
+                'ai_calls': ai_client.get_call_stats()['calls'] - calls_before,
+            }
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='合并流程的端到端基准测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='表2/表3的行数')
+    parser.add_argument('--work-dir', default=WORK_DIR, help='合成数据和运行结果目录')
+    parser.add_argument('--mock-latency', type=float, default=0.0, help='模拟AI接口的平均延迟（秒）')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--output', default=RESULTS_FILE, help='结果文件')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='用于比较的基线结果文件')
+    parser.add_argument('--save-baseline', action='store_true', help='将本次结果保存为基线')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE, help='允许的耗时增长比例')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.work_dir, args.mock_latency, args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到{args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"已保存为基线：{args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\n与基线比较（{args.baseline}，{baseline.get('created')}）：")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n发现{len(regressions)}处性能回退")
+            sys.exit(1)
+        print("\n没有发现性能回退")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,23 @@
-import pandas as pd
-from openai import OpenAI
+from workbook_loader import read_headers
+from ai_client import MODEL, achat_completion, chat_completion
+import asyncio
+import json
 import os
+import re
+import time
+from collections import Counter
 
 # 当前使用的模型
-CURRENT_MODEL = "***"
+CURRENT_MODEL = MODEL
+
+# 共识模式：并行请求数、采用结果所需的一致票数，以及写入缓存所需的最低一致比例
+CONSENSUS_K = 3
+CONSENSUS_QUORUM = 2
+CONSENSUS_MIN_AGREEMENT = 0.6
+
+# AI返回的对应关系行，如“表1的第3列 对应 表2的第4列”或“表1的3对应表2的4”
+MAPPING_LINE_PATTERN = re.compile(
+    r'表\s*\d+\s*的\s*第?\s*(\d+)\s*列?\s*对应\s*表\s*\d+\s*的\s*第?\s*(\d+)\s*列?')
 
 # 性能测试数据保存路径
 def get_performance_data_file():
@@ -30,24 +44,25 @@ def save_performance_data(data):
 def read_excel_headers(file_path, header_row=0):
     """读取Excel文件的表头"""
     try:
-        df = pd.read_excel(file_path, header=header_row)
-        return df.columns.tolist()
+        return read_headers(file_path, header_row=header_row)
     except Exception as e:
         print(f"读取Excel文件出错：{str(e)}")
         return None
 
-def compare_headers_with_ai(headers1, headers2, is_comparing_2_and_3=False, is_comparing_1_and_3=False):
-    """使用AI比较两个表的表头并建立映射关系"""
-    
-    # 初始化API客户端
-    client = OpenAI(
-        api_key="***",
-        base_url="***"
-    )
+def build_compare_messages(headers1, headers2, is_comparing_2_and_3=False, is_comparing_1_and_3=False,
+                           indices1=None, indices2=None):
+    """
+    构建表头比较请求的消息
     
+    indices1/indices2指定只发送哪些列（如本地未能匹配的列），列号保持原表中的编号
+    """
     # 构建提示信息
-    headers1_str = "\n".join([f"{i+1}. {h}" for i, h in enumerate(headers1)])
-    headers2_str = "\n".join([f"{i+1}. {h}" for i, h in enumerate(headers2)])
+    if indices1 is None:
+        indices1 = range(len(headers1))
+    if indices2 is None:
+        indices2 = range(len(headers2))
+    headers1_str = "\n".join([f"{i+1}. {headers1[i]}" for i in indices1])
+    headers2_str = "\n".join([f"{i+1}. {headers2[i]}" for i in indices2])
     
     # 根据不同的比较场景选择不同的提示信息
     if is_comparing_2_and_3:
@@ -102,23 +117,92 @@ def compare_headers_with_ai(headers1, headers2, is_comparing_2_and_3=False, is_c
 4. 如果找不到对应关系，就不要输出
 5. 请特别注意"学号"列的对应关系，这个是关键"""
 
+    return [
+        {"role": "system", "content": "你是一个专门分析Excel表头并建立映射关系的助手。请直接返回映射关系，不要返回其他内容。"},
+        {"role": "user", "content": prompt}
+    ]
+
+def compare_headers_with_ai(headers1, headers2, is_comparing_2_and_3=False, is_comparing_1_and_3=False,
+                            indices1=None, indices2=None, coalesce=True):
+    """
+    使用AI比较两个表的表头并建立映射关系（参数见build_compare_messages）
+    
+    coalesce为True时，与同时进行的相同请求共享一次调用；需要多次独立回答（如一致性测试）时设为False
+    """
+    messages = build_compare_messages(headers1, headers2, is_comparing_2_and_3, is_comparing_1_and_3,
+                                      indices1, indices2)
     try:
-        # 调用API进行分析
-        response = client.chat.completions.create(
-            model="***",
-            messages=[
-                {"role": "system", "content": "你是一个专门分析Excel表头并建立映射关系的助手。请直接返回映射关系，不要返回其他内容。"},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        
-        # 返回API响应
-        return response.choices[0].message.content
-        
+        # 调用API进行分析（使用共享客户端，临时性错误自动重试）
+        return chat_completion(messages=messages, label="compare_headers", coalesce=coalesce)
     except Exception as e:
         print(f"调用AI API出错：{str(e)}")
         return None
 
+async def acompare_headers_with_ai(headers1, headers2, is_comparing_2_and_3=False, is_comparing_1_and_3=False,
+                                   indices1=None, indices2=None, coalesce=True):
+    """compare_headers_with_ai的异步版本"""
+    messages = build_compare_messages(headers1, headers2, is_comparing_2_and_3, is_comparing_1_and_3,
+                                      indices1, indices2)
+    try:
+        return await achat_completion(messages=messages, label="compare_headers", coalesce=coalesce)
+    except Exception as e:
+        print(f"调用AI API出错：{str(e)}")
+        return None
+
+def parse_ai_response(response_text):
+    """
+    解析AI响应文本，转换为字典映射（第二个表的列索引 -> 第一个表的列索引，均为0-based）
+    
+    兼容“表1的第3列 对应 表2的第4列”和“表1的3对应表2的4”等写法，其他行忽略
+    """
+    mapping = {}
+    for match in MAPPING_LINE_PATTERN.finditer(response_text or ''):
+        idx1 = int(match.group(1)) - 1
+        idx2 = int(match.group(2)) - 1
+        # 创建映射关系（从第二个表到第一个表）
+        mapping[idx2] = idx1
+    return mapping
+
+async def acompare_headers_consensus(headers1, headers2, is_comparing_2_and_3=False, is_comparing_1_and_3=False,
+                                     indices1=None, indices2=None, k=CONSENSUS_K, quorum=CONSENSUS_QUORUM):
+    """
+    共识模式：并行发送k个相同的映射请求，解析为与顺序无关的映射后投票
+    
+    某个映射得到quorum票时立即采用，并取消仍在进行的请求；全部结束仍未达到时采用票数最多的映射。
+    
+    返回：
+        (mapping, agreement)。mapping为得票最多的映射（全部请求失败时为None），
+        agreement为其票数占已返回结果的比例
+    """
+    tasks = [asyncio.create_task(acompare_headers_with_ai(headers1, headers2, is_comparing_2_and_3,
+                                                          is_comparing_1_and_3, indices1, indices2,
+                                                          coalesce=False))
+             for _ in range(k)]
+    votes = Counter()
+    answered = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            response = await next_done
+            # 调用失败时为None；空回答表示剩余列之间没有对应关系，同样计票
+            if response is None:
+                continue
+            answered += 1
+            # frozenset使列出顺序不同的相同映射得到同一个键
+            key = frozenset(parse_ai_response(response).items())
+            votes[key] += 1
+            if votes[key] >= quorum:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    if not votes:
+        return None, 0.0
+    key, count = votes.most_common(1)[0]
+    agreement = count / answered
+    print(f"共识结果：{count}/{answered}个回复一致（共发送{k}个请求）")
+    return dict(key), agreement
+
 def run_performance_test(headers1, headers2, is_comparing_2_and_3=False, is_comparing_1_and_3=False):
     """
     运行性能测试
@@ -131,7 +215,8 @@ def run_performance_test(headers1, headers2, is_comparing_2_and_3=False, is_comp
     for i in range(10):
         print(f"\n运行测试 {i+1}/10")
         start_time = time.time()
-        result = compare_headers_with_ai(headers1, headers2, is_comparing_2_and_3, is_comparing_1_and_3)
+        result = compare_headers_with_ai(headers1, headers2, is_comparing_2_and_3, is_comparing_1_and_3,
+                                         coalesce=False)
         end_time = time.time()
         
         elapsed_time = end_time - start_time
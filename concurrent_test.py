@@ -1,86 +1,250 @@
-import multiprocessing
-from compare_headers import read_excel_headers, compare_headers_with_ai
-from tqdm import tqdm
+import argparse
+import asyncio
 import json
-from collections import Counter
+import math
 import time
-import os
+from collections import Counter
+from tqdm import tqdm
+import ai_client
+from ai_client import achat_completion, get_async_client
+from compare_headers import build_compare_messages, parse_ai_response, read_excel_headers
+
+# 默认的测试文件
+FILE1_PATH = "/Users/yuii/Downloads/aiexcel/副本xx班xx假期离返校去向表.xlsx"
+FILE3_PATH = "/Users/yuii/Downloads/aiexcel/人工智能-34人-教务原始数据.xlsx"
+
+# 没有测试文件时使用的示例表头
+SAMPLE_HEADERS1 = ['序号', '姓名', '学号', '联系电话', '离校时间', '返校时间', '去向', '签名']
+SAMPLE_HEADERS3 = ['学号', '姓名', '性别', '班级', '宿舍号', '本人电话', '家长联系电话']
+
+# 延迟直方图的分桶上界（秒）
+HISTOGRAM_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+RESULTS_FILE = 'concurrent_test_results.json'
+
+def percentile(sorted_values, q):
+    """计算已排序数据的q分位数（线性插值）"""
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q
+    low, high = math.floor(pos), math.ceil(pos)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (pos - low)
 
-def process_single_comparison(headers1, headers3):
+def latency_histogram(latencies, buckets=HISTOGRAM_BUCKETS):
+    """按分桶上界统计延迟分布，返回 {"<=上界": 次数}，超过最大上界的计入 ">最大上界" """
+    histogram = {f"<={b}s": 0 for b in buckets}
+    histogram[f">{buckets[-1]}s"] = 0
+    for latency in latencies:
+        for b in buckets:
+            if latency <= b:
+                histogram[f"<={b}s"] += 1
+                break
+        else:
+            histogram[f">{buckets[-1]}s"] += 1
+    return histogram
+
+async def send_request(messages, raw=False):
+    """
+    发送一次表头比较请求，返回 (结果文本, 错误类型, 延迟)
+
+    raw为True时直接使用共享的异步客户端发送（不经过限流、重试和请求合并），用于测量接口本身；
+    否则走完整的achat_completion调用路径。
+    """
+    started = time.perf_counter()
     try:
-        result = compare_headers_with_ai(headers1, headers3, is_comparing_2_and_3=False, is_comparing_1_and_3=True)
-        return result.strip() if result else ""
+        if raw:
+            response = await get_async_client().chat.completions.create(model=ai_client.MODEL, messages=messages)
+            content = response.choices[0].message.content
+        else:
+            content = await achat_completion(messages=messages, label="load_test", coalesce=False)
+        return (content or "").strip(), None, time.perf_counter() - started
     except Exception as e:
-        return f"Error: {str(e)}"
+        return None, type(e).__name__, time.perf_counter() - started
+
+async def run_load(messages, total_tests, mode='closed', concurrency=50, rps=10.0, raw=False):
+    """
+    异步压测
+
+    参数：
+        messages：每次发送的请求消息
+        total_tests：请求总数
+        mode：closed为闭环（concurrency个并发工作者，完成一个再发下一个），
+              open为开环（按rps匀速发出，不等待之前的请求完成）
+        concurrency：闭环模式的并发数
+        rps：开环模式的目标每秒请求数
+        raw：是否绕过限流、重试和请求合并
+
+    返回：
+        (records, total_time)。records为每次请求的(结果文本, 错误类型, 延迟, 发出时的排队延迟)
+    """
+    records = []
+    pbar = tqdm(total=total_tests, desc="Processing comparisons")
+    errors = Counter()
+
+    def finish(result, lag=0.0):
+        content, error, latency = result
+        records.append((content, error, latency, lag))
+        if error:
+            errors[error] += 1
+            pbar.set_postfix(errors=sum(errors.values()))
+        pbar.update()
+
+    start_time = time.perf_counter()
+    if mode == 'open':
+        # 第i个请求在 start + i/rps 时发出，实际发出时间晚于计划的部分记为排队延迟
+        async def scheduled(i):
+            lag = time.perf_counter() - (start_time + i / rps)
+            finish(await send_request(messages, raw), max(0.0, lag))
+
+        tasks = []
+        for i in range(total_tests):
+            delay = start_time + i / rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(scheduled(i)))
+        await asyncio.gather(*tasks)
+    else:
+        remaining = iter(range(total_tests))
 
-def run_concurrent_tests(total_tests=500):
+        async def worker():
+            for _ in remaining:
+                finish(await send_request(messages, raw))
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, total_tests))))
+    pbar.close()
+    return records, time.perf_counter() - start_time
+
+def summarize(records, total_time):
+    """汇总延迟分位数、直方图、各类错误次数和结果一致性"""
+    ok = [r for r in records if r[1] is None]
+    latencies = sorted(r[2] for r in ok)
+    lags = sorted(r[3] for r in records)
+    result_counter = Counter(r[0] for r in ok)
+    # 与行顺序无关的映射分布
+    mapping_counter = Counter(
+        json.dumps(sorted(parse_ai_response(r[0]).items())) for r in ok)
+    return {
+        "latency": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "histogram": latency_histogram(latencies),
+        },
+        "schedule_lag": {
+            "p50": percentile(lags, 0.50),
+            "p99": percentile(lags, 0.99),
+        },
+        "throughput": len(records) / total_time if total_time else 0.0,
+        "successes": len(ok),
+        "errors": dict(Counter(r[1] for r in records if r[1] is not None)),
+        "results": {str(k): v for k, v in result_counter.most_common()},
+        "mappings": {k: v for k, v in mapping_counter.most_common()},
+    }
+
+def run_concurrent_tests(total_tests=500, mode='closed', concurrency=50, rps=10.0, raw=False,
+                         file1_path=FILE1_PATH, file3_path=FILE3_PATH, sample_headers=False):
+    """对表1与表3的表头比较请求进行压测，结果保存到concurrent_test_results.json"""
     # 读取表头
-    file1_path = "/Users/yuii/Downloads/aiexcel/副本xx班xx假期离返校去向表.xlsx"
-    file3_path = "/Users/yuii/Downloads/aiexcel/人工智能-34人-教务原始数据.xlsx"
-    
-    headers1 = read_excel_headers(file1_path, header_row=1)
-    headers3 = read_excel_headers(file3_path, header_row=1)
-    
+    if sample_headers:
+        headers1, headers3 = SAMPLE_HEADERS1, SAMPLE_HEADERS3
+    else:
+        headers1 = read_excel_headers(file1_path, header_row=1)
+        headers3 = read_excel_headers(file3_path, header_row=1)
+
     if not headers1 or not headers3:
         print("无法读取表头数据")
         return
 
-    # 创建进程池
-    num_processes = min(multiprocessing.cpu_count() * 2, total_tests)  # 使用CPU核心数的2倍作为进程数
-    pool = multiprocessing.Pool(processes=num_processes)
-    
-    print(f"使用 {num_processes} 个进程进行并发测试")
-    
-    # 创建参数列表
-    args = [(headers1, headers3) for _ in range(total_tests)]
-    
-    # 使用进度条显示进度
-    start_time = time.time()
-    results = []
-    with tqdm(total=total_tests, desc="Processing comparisons") as pbar:
-        for result in pool.starmap(process_single_comparison, args):
-            results.append(result)
-            pbar.update()
-    
-    # 关闭进程池
-    pool.close()
-    pool.join()
-    
-    end_time = time.time()
-    
-    # 分析结果
-    result_counter = Counter(results)
-    total_time = end_time - start_time
-    
+    messages = build_compare_messages(headers1, headers3, is_comparing_1_and_3=True)
+    if mode == 'open':
+        print(f"开环模式：目标 {rps} 请求/秒，共 {total_tests} 个请求")
+    else:
+        print(f"闭环模式：{concurrency} 个并发，共 {total_tests} 个请求")
+
+    records, total_time = asyncio.run(run_load(messages, total_tests, mode, concurrency, rps, raw))
+    summary = summarize(records, total_time)
+    latency = summary["latency"]
+
     # 输出分析报告
     print("\n=== 测试结果分析 ===")
     print(f"总测试次数: {total_tests}")
     print(f"总耗时: {total_time:.2f} 秒")
-    print(f"平均每次耗时: {(total_time/total_tests):.2f} 秒")
-    print(f"进程数: {num_processes}")
-    print("\n不同结果的分布:")
-    
+    print(f"吞吐量: {summary['throughput']:.2f} 请求/秒")
+    print(f"成功: {summary['successes']}，失败: {total_tests - summary['successes']}")
+    print(f"延迟 p50/p95/p99: {latency['p50']:.3f} / {latency['p95']:.3f} / {latency['p99']:.3f} 秒"
+          f"（最大 {latency['max']:.3f} 秒）")
+    if mode == 'open':
+        print(f"发出排队延迟 p50/p99: {summary['schedule_lag']['p50']:.3f} / {summary['schedule_lag']['p99']:.3f} 秒")
+    print("\n延迟分布:")
+    peak = max(latency["histogram"].values()) or 1
+    for bucket, count in latency["histogram"].items():
+        print(f"{bucket:>8} {count:6d} {'#' * round(40 * count / peak)}")
+    if summary["errors"]:
+        print("\n错误类型:")
+        for error, count in summary["errors"].items():
+            print(f"{error}: {count}")
+
     # 将结果保存到文件
     output_data = {
         "test_info": {
             "total_tests": total_tests,
             "total_time": total_time,
             "avg_time": total_time/total_tests,
-            "num_processes": num_processes
+            "mode": mode,
+            "concurrency": concurrency if mode == 'closed' else None,
+            "target_rps": rps if mode == 'open' else None,
+            "raw": raw,
+            "model": ai_client.MODEL,
         },
-        "results": {str(k): v for k, v in result_counter.items()}
+        "latency": summary["latency"],
+        "schedule_lag": summary["schedule_lag"],
+        "throughput": summary["throughput"],
+        "errors": summary["errors"],
+        "results": summary["results"],
+        "mappings": summary["mappings"],
     }
-    
+
     # 保存详细结果到JSON文件
-    with open('concurrent_test_results.json', 'w', encoding='utf-8') as f:
+    with open(RESULTS_FILE, 'w', encoding='utf-8') as f:
         json.dump(output_data, f, ensure_ascii=False, indent=2)
-    
-    # 打印结果分布
-    for result, count in result_counter.items():
+
+    # 打印结果分布（与行顺序无关的映射）
+    print("\n不同结果的分布:")
+    for mapping, count in summary["mappings"].items():
         percentage = (count / total_tests) * 100
         print(f"\n出现 {count} 次 ({percentage:.2f}%):")
-        print(result)
+        print(mapping)
+    return output_data
+
+def main():
+    parser = argparse.ArgumentParser(description='表头比较请求的异步压测')
+    parser.add_argument('--total', type=int, default=500, help='请求总数')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed', help='闭环或开环')
+    parser.add_argument('--concurrency', type=int, default=50, help='闭环模式的并发数')
+    parser.add_argument('--rps', type=float, default=10.0, help='开环模式的目标每秒请求数')
+    parser.add_argument('--raw', action='store_true', help='绕过限流、重试和请求合并，直接测量接口')
+    parser.add_argument('--file1', default=FILE1_PATH, help='表1路径')
+    parser.add_argument('--file3', default=FILE3_PATH, help='表3路径')
+    parser.add_argument('--sample-headers', action='store_true', help='使用内置示例表头，不读取文件')
+    parser.add_argument('--mock', action='store_true', help='在本进程启动模拟接口（见mock_server.py）并对其压测')
+    parser.add_argument('--mock-latency', type=float, default=0.5, help='模拟接口的平均延迟（秒）')
+    parser.add_argument('--mock-error-rate', type=float, default=0.0, help='模拟接口的错误率')
+    args = parser.parse_args()
+
+    server = None
+    if args.mock:
+        from mock_server import MockConfig, start_server
+        server, ai_client.BASE_URL = start_server(MockConfig(
+            latency='lognormal', latency_mean=args.mock_latency, error_rate=args.mock_error_rate))
+    try:
+        run_concurrent_tests(total_tests=args.total, mode=args.mode, concurrency=args.concurrency, rps=args.rps,
+                             raw=args.raw, file1_path=args.file1, file3_path=args.file3,
+                             sample_headers=args.sample_headers)
+    finally:
+        if server is not None:
+            server.shutdown()
 
 if __name__ == "__main__":
-    multiprocessing.freeze_support()  # Windows支持
-    run_concurrent_tests(total_tests=500)
+    main()
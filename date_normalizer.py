@@ -0,0 +1,96 @@
+import re
+from numbers import Number
+from datetime import date, datetime
+import pandas as pd
+
+# 匹配常见的日期写法：1月7日、1/7、2024/1/7、2024-01-07、2024年1月7日、1.7 等，
+# 允许末尾带有时间部分（如“2024-01-07 00:00:00”）
+DATE_PATTERN = re.compile(
+    r'^\s*(?:(?P<year>\d{4})\s*[年/\-.]\s*)?'
+    r'(?P<month>\d{1,2})\s*[月/\-.]\s*(?P<day>\d{1,2})\s*[日号]?'
+    r'(?:\s+\d{1,2}:\d{2}(?::\d{2})?)?\s*$'
+)
+
+# Excel序列日期的起点及认为合理的取值范围（约1954年至2119年）
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+EXCEL_SERIAL_RANGE = (20000, 80000)
+
+# 未写年份时用闰年校验日期，使2月29日可以通过
+DEFAULT_YEAR = 2000
+
+def _is_missing(value):
+    """判断单元格是否为空值或空白字符串"""
+    if isinstance(value, str):
+        return not value.strip()
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+def _format_timestamps(timestamps):
+    """将时间戳序列格式化为mm.dd，无效值为None"""
+    return timestamps.dt.strftime('%m.%d').astype(object).where(timestamps.notna(), None)
+
+def _parse_serials(serials):
+    """将Excel序列日期转换为mm.dd，超出合理范围的为None"""
+    serials = pd.to_numeric(serials, errors='coerce')
+    low, high = EXCEL_SERIAL_RANGE
+    serials = serials.where((serials >= low) & (serials <= high))
+    timestamps = EXCEL_EPOCH + pd.to_timedelta(serials.floordiv(1), unit='D')
+    return _format_timestamps(timestamps)
+
+def _parse_text(texts):
+    """按DATE_PATTERN解析文本日期，无法解析或日期不存在的为None"""
+    parts = texts.str.extract(DATE_PATTERN)
+    year = pd.to_numeric(parts['year'], errors='coerce').fillna(DEFAULT_YEAR)
+    timestamps = pd.to_datetime(
+        pd.DataFrame({
+            'year': year,
+            'month': pd.to_numeric(parts['month'], errors='coerce'),
+            'day': pd.to_numeric(parts['day'], errors='coerce'),
+        }),
+        errors='coerce'
+    )
+    return _format_timestamps(timestamps)
+
+def parse_dates_locally(dates):
+    """
+    在本地将日期统一转换为mm.dd格式
+
+    支持日期/时间单元格、Excel序列日期以及常见的文本写法。
+    相同的值只解析一次，再按值映射回每一行。
+
+    参数：
+        dates：原始日期值列表
+
+    返回：
+        与dates等长的列表。空值为''，成功解析的为mm.dd字符串，
+        无法在本地解析的为None
+    """
+    values = pd.Series(list(dates), dtype=object)
+    missing = values.map(_is_missing).astype(bool)
+    uniques = pd.Series(pd.unique(values[~missing]), dtype=object)
+    parsed = pd.Series(None, index=uniques.index, dtype=object)
+
+    if not uniques.empty:
+        # 日期/时间类型的单元格
+        is_datetime = uniques.map(lambda v: isinstance(v, (datetime, date))).astype(bool)
+        if is_datetime.any():
+            parsed[is_datetime] = _format_timestamps(pd.to_datetime(uniques[is_datetime], errors='coerce'))
+
+        # 数值单元格及纯数字文本按Excel序列日期处理，
+        # 像1.7这样的小数文本仍按“月.日”解析
+        is_number = uniques.map(lambda v: isinstance(v, Number) and not isinstance(v, bool)).astype(bool)
+        texts = uniques[~is_datetime].astype(str).str.strip()
+        is_serial = is_number[~is_datetime] | texts.str.fullmatch(r'\d{5}')
+        if is_serial.any():
+            parsed[is_serial[is_serial].index] = _parse_serials(texts[is_serial])
+
+        # 其余按文本日期解析
+        rest = texts[~is_serial]
+        if not rest.empty:
+            parsed[rest.index] = _parse_text(rest)
+
+    lookup = dict(zip(uniques, parsed))
+    return ['' if is_missing else lookup.get(value)
+            for value, is_missing in zip(values, missing)]
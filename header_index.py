@@ -0,0 +1,98 @@
+import numpy as np
+from header_matcher import normalize_header
+
+# 相似度不低于该值时直接采用历史映射，不再询问AI
+SIMILARITY_THRESHOLD = 0.8
+
+def _ngrams(text, sizes=(1, 2)):
+    """提取字符n-gram（默认单字和相邻两字）"""
+    return [text[i:i + n] for n in sizes for i in range(len(text) - n + 1)]
+
+class HeaderSimilarityIndex:
+    """历史上已确认的“表头 -> 模板列”对应关系的相似度索引"""
+
+    def __init__(self, pairs):
+        """
+        参数：
+            pairs：(来源表头, 模板表头, 确认次数) 列表，通常来自MappingCache.get_header_pairs()
+        """
+        # 同一来源表头对应多个模板列时都保留，确认次数多的在前（相似度相同时优先采用）
+        counts = {}
+        for source, target, confirmations in pairs:
+            norm = normalize_header(source)
+            if norm:
+                counts[(norm, target)] = counts.get((norm, target), 0) + confirmations
+        entries = sorted(counts, key=lambda entry: -counts[entry])
+
+        self.sources = [norm for norm, _ in entries]
+        self.targets = [target for _, target in entries]
+        self.vocabulary = {}
+        for norm in self.sources:
+            for gram in _ngrams(norm):
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+        self.matrix = self._vectorize(self.sources)
+
+    @classmethod
+    def from_cache(cls, cache):
+        """从MappingCache中已确认的表头对建立索引"""
+        return cls(cache.get_header_pairs())
+
+    def _vectorize(self, norms):
+        """将规范化表头转换为L2归一化的n-gram计数矩阵，词表外的n-gram只计入范数"""
+        matrix = np.zeros((len(norms), len(self.vocabulary)), dtype=np.float32)
+        norms_sq = np.zeros(len(norms), dtype=np.float32)
+        for row, norm in enumerate(norms):
+            grams = _ngrams(norm)
+            for gram in grams:
+                col = self.vocabulary.get(gram)
+                if col is not None:
+                    matrix[row, col] += 1
+            counts = {}
+            for gram in grams:
+                counts[gram] = counts.get(gram, 0) + 1
+            norms_sq[row] = sum(c * c for c in counts.values())
+        lengths = np.sqrt(norms_sq)
+        lengths[lengths == 0] = 1
+        return matrix / lengths[:, None]
+
+    def infer_mapping(self, headers1, headers2, indices1=None, indices2=None,
+                      threshold=SIMILARITY_THRESHOLD):
+        """
+        用一次矩阵运算为表2的表头查找最相似的历史表头，推断其在表1中的对应列
+
+        参数：
+            headers1：表1（模板）的表头
+            headers2：另一个表的表头
+            indices1/indices2：只在这些列之间推断（默认全部列）
+            threshold：采用推断结果的最低相似度
+
+        返回：
+            (mapping, report)。mapping为表2列索引到表1列索引的映射，
+            report为每个推断列的(表2表头, 历史表头, 表1表头, 相似度)列表
+        """
+        indices1 = list(range(len(headers1)) if indices1 is None else indices1)
+        indices2 = list(range(len(headers2)) if indices2 is None else indices2)
+        if not self.sources or not indices1 or not indices2:
+            return {}, []
+
+        queries = [normalize_header(headers2[j]) for j in indices2]
+        similarity = self._vectorize(queries) @ self.matrix.T
+
+        # 模板表头 -> 表1中未匹配的列索引
+        target_columns = {}
+        for i in indices1:
+            target_columns.setdefault(str(headers1[i]), i)
+
+        # 所有达到阈值的(表2列, 历史表头)组合按相似度从高到低一对一分配，
+        # 最相似的历史表头对应的列已被占用时继续尝试次相似的
+        candidates = np.argwhere(similarity >= threshold)
+        order = np.argsort(-similarity[candidates[:, 0], candidates[:, 1]], kind='stable')
+        mapping, report = {}, []
+        for k, row in candidates[order]:
+            idx2 = indices2[k]
+            idx1 = target_columns.get(self.targets[row])
+            if idx2 in mapping or idx1 is None or idx1 in mapping.values():
+                continue
+            mapping[idx2] = idx1
+            report.append((headers2[idx2], self.sources[row], headers1[idx1], float(similarity[k, row])))
+        return mapping, report
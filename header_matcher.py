@@ -0,0 +1,126 @@
+import json
+import os
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+# 同义词表：标准名称 -> 常见写法。可在header_synonyms.json中补充或覆盖
+DEFAULT_SYNONYMS = {
+    '学号': ['学生编号', '学籍号', '学生学号'],
+    '姓名': ['名字', '学生姓名', '真实姓名'],
+    '联系电话': ['电话', '手机', '手机号', '手机号码', '联系方式', '本人电话'],
+    '家长电话': ['家长联系电话', '家长手机号', '紧急联系人电话'],
+    '离校时间': ['离校日期', '出发时间', '离开学校时间'],
+    '返校时间': ['返校日期', '到校时间', '回校时间'],
+    '去向': ['目的地', '假期去向', '去向地址', '前往地点'],
+    '宿舍': ['宿舍号', '寝室', '寝室号', '宿舍号码'],
+    '签名': ['本人签名', '学生签名', '签字'],
+}
+SYNONYMS_FILE = 'header_synonyms.json'
+
+# 表头中常见的引导语和标点，比较前去掉
+PREFIXES = ('请输入你的', '请输入您的', '请输入', '请填写你的', '请填写您的', '请填写', '请选择', '你的', '您的')
+BRACKETS = re.compile(r'\([^)]*\)|\[[^\]]*\]|【[^】]*】|<[^>]*>|《[^》]*》')
+PUNCTUATION = re.compile(r'[\s:：?？!！,，.。、*＊_\-/]+')
+
+# 得分不低于MATCH_THRESHOLD的表头直接认为是同一列，其余的列交给AI按含义判断
+MATCH_THRESHOLD = 0.85
+
+# 模板中在本地生成的列（如按行号填写的序号），不需要在其他表中找对应的列
+LOCAL_COLUMNS = ('序号',)
+
+# 一个表头包含另一个表头（如“姓名”和“家长姓名”）时含义可能不同，
+# 得分不超过该值（低于MATCH_THRESHOLD），只作为交给AI判断的候选
+CONTAINMENT_MAX_SCORE = 0.8
+
+def load_synonyms(synonyms_file=SYNONYMS_FILE):
+    """读取同义词表，文件中的条目补充到默认同义词表中"""
+    synonyms = {name: list(variants) for name, variants in DEFAULT_SYNONYMS.items()}
+    if os.path.exists(synonyms_file):
+        try:
+            with open(synonyms_file, 'r', encoding='utf-8') as f:
+                for name, variants in json.load(f).items():
+                    synonyms.setdefault(name, []).extend(variants)
+        except Exception as e:
+            print(f"读取同义词表出错：{str(e)}")
+    return synonyms
+
+def normalize_header(header):
+    """规范化表头：统一全角/半角，去掉括号内容（如“（必填）”）、引导语、标点和空白"""
+    text = unicodedata.normalize('NFKC', str(header)).lower()
+    text = BRACKETS.sub('', text)
+    text = PUNCTUATION.sub('', text)
+    for prefix in PREFIXES:
+        if text.startswith(prefix) and len(text) > len(prefix):
+            text = text[len(prefix):]
+            break
+    return text
+
+def _build_canonical(synonyms):
+    """建立规范化写法到标准名称的查找表"""
+    canonical = {}
+    for name, variants in synonyms.items():
+        for variant in [name] + list(variants):
+            canonical[normalize_header(variant)] = name
+    return canonical
+
+def score_headers(norm1, norm2, canonical):
+    """计算两个规范化表头的相似度（0~1）"""
+    if not norm1 or not norm2:
+        return 0.0
+    if norm1 == norm2:
+        return 1.0
+    name1, name2 = canonical.get(norm1), canonical.get(norm2)
+    if name1 is not None and name1 == name2:
+        return 0.95
+    shorter, longer = sorted((norm1, norm2), key=len)
+    if len(shorter) >= 2 and shorter in longer:
+        return CONTAINMENT_MAX_SCORE - 0.2 * (1 - len(shorter) / len(longer))
+    return SequenceMatcher(None, norm1, norm2).ratio()
+
+def match_headers(headers1, headers2, synonyms=None, threshold=MATCH_THRESHOLD):
+    """
+    在本地按规则匹配两个表的表头
+
+    参数：
+        headers1：表1（模板）的表头
+        headers2：另一个表的表头
+        synonyms：同义词表，默认读取load_synonyms()
+        threshold：认为两列相同的最低得分
+
+    返回：
+        (mapping, unresolved1, unresolved2, scores)。mapping为表2列索引到表1列索引的映射，
+        unresolved1/unresolved2为未匹配的列索引，scores为所有列组合的得分
+    """
+    canonical = _build_canonical(load_synonyms() if synonyms is None else synonyms)
+    norms1 = [normalize_header(h) for h in headers1]
+    norms2 = [normalize_header(h) for h in headers2]
+    scores = {(i, j): score_headers(n1, n2, canonical)
+              for i, n1 in enumerate(norms1) for j, n2 in enumerate(norms2)}
+
+    # 按得分从高到低一对一分配
+    mapping = {}
+    used1 = set()
+    for (i, j), score in sorted(scores.items(), key=lambda item: -item[1]):
+        if score < threshold:
+            break
+        if i in used1 or j in mapping:
+            continue
+        mapping[j] = i
+        used1.add(i)
+
+    unresolved1 = [i for i in range(len(headers1)) if i not in used1]
+    unresolved2 = [j for j in range(len(headers2)) if j not in mapping]
+    return mapping, unresolved1, unresolved2, scores
+
+def columns_for_ai(headers1, unresolved1, unresolved2):
+    """
+    返回需要交给AI判断的剩余列(indices1, indices2)，不需要时返回None
+
+    表头写法不同但含义相同的列（如“去向”和“假期打算去哪里”）得分可能很低，
+    因此只要两边都还有未匹配的列（不含本地生成的列）就交给AI
+    """
+    indices1 = [i for i in unresolved1 if headers1[i] not in LOCAL_COLUMNS]
+    if not indices1 or not unresolved2:
+        return None
+    return indices1, list(unresolved2)
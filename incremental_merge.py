@@ -0,0 +1,340 @@
+"""
+增量合并：问卷表只新增行时，只处理新增或修改过的行
+
+每次合并后在输出目录保存状态文件（merge_state.pkl），其中包括各来源每行的指纹
+（按连接键分组的行哈希）和合并后的完整结果。再次运行时只对指纹发生变化的连接键
+重新构建、统一日期格式和合并，然后与上次的结果拼接，旧行不会再次调用AI。
+
+第一次运行写出完整的结果文件；之后默认只写出包含新增和修改行的增量文件
+（Merged_delta_时间.xlsx），写出耗时只与新增行数有关；--full-output同时重写完整结果。
+状态文件记录最近的完整结果和之后写出的增量文件，输入没有变化而仍有未合入的增量文件时，
+用保存的完整结果重写完整结果文件（不需要重新解析和调用AI）。
+模板表头、列映射关系或任务配置变化时自动全量重建。
+
+使用方法：
+    python incremental_merge.py merge_job.json
+    python incremental_merge.py merge_job.json --watch    # 输入文件变化时自动重新合并
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from ai_client import get_call_stats
+from mapping_cache import MappingCache
+from value_cache import ValueCache
+from workbook_loader import load_workbook_table
+from tracing import span
+from merge_excel import format_date_columns, format_date_columns_async, normalize_student_ids, write_formatted_excel
+from merge_engine import (join_frames, load_job_spec, load_sources, normalize_job_spec, prepare_frame,
+                          sort_frame, source_key_column)
+
+STATE_NAME = 'merge_state.pkl'
+STATE_VERSION = 3
+DELTA_NAME = 'Merged_delta_{timestamp}.xlsx'
+
+# 结果中记录每行所属连接键的列，写出前删除
+ROW_ID = '__row_id__'
+
+# 监视模式下检查输入文件的间隔（秒）
+WATCH_INTERVAL = 2.0
+
+def _cell_text(column):
+    """
+    列中每个单元格的文本形式，与pandas推断的列类型无关
+
+    新增一行可能改变整列的类型（如整数列出现空值变为浮点数，日期列出现文本变为object），
+    旧行的文本形式不受影响：整数值的浮点数写为整数，日期写为str(datetime)，空值写为空字符串。
+    """
+    missing = column.isna().to_numpy()
+    if pd.api.types.is_float_dtype(column):
+        values = column.to_numpy(dtype=float, na_value=np.nan)
+        integral = np.isfinite(values) & (np.floor(values) == values) & (np.abs(values) < 2**63)
+        text = column.astype(str).to_numpy(dtype=object)
+        text[integral] = values[integral].astype(np.int64).astype(str)
+    elif pd.api.types.is_datetime64_any_dtype(column):
+        if ((column.dt.microsecond != 0) | (column.dt.nanosecond != 0)).any():
+            text = column.astype(object).map(str).to_numpy(dtype=object)
+        else:
+            # 与str(datetime)相同，但按列一次格式化
+            text = column.dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=object)
+    else:
+        text = column.astype(str).to_numpy(dtype=object)
+    text[missing] = ''
+    return text
+
+def row_fingerprints(df, key_column):
+    """
+    计算每行的连接键和按连接键分组的行指纹
+
+    行哈希按单元格的文本形式计算（见_cell_text），只取决于该行的内容。
+    连接键为空的行以“#行哈希”作为连接键，内容不变时同样能识别为旧行。
+
+    返回：
+        (每行的连接键Series, {连接键: 行哈希，有多行时为各行哈希按顺序拼接的字符串})
+    """
+    text = pd.DataFrame({i: _cell_text(df[column]) for i, column in enumerate(df.columns)}, index=df.index)
+    hashes = pd.util.hash_pandas_object(text, index=False)
+    if key_column is not None and key_column in df.columns:
+        ids = normalize_student_ids(df[key_column])
+    else:
+        ids = pd.Series(pd.NA, index=df.index, dtype='string')
+    ids = ids.fillna('#' + hashes.astype(str))
+    # 大多数连接键只有一行，直接使用行哈希；只对重复的连接键分组拼接
+    duplicated = ids.duplicated(keep=False).to_numpy()
+    fingerprints = dict(zip(ids[~duplicated], hashes[~duplicated].tolist()))
+    if duplicated.any():
+        grouped = hashes[duplicated].astype(str).groupby(ids[duplicated].to_numpy(), sort=False).agg(','.join)
+        fingerprints.update(grouped.to_dict())
+    return ids, fingerprints
+
+def changed_ids(old, new):
+    """新增、修改或删除的连接键"""
+    return {row_id for row_id in old.keys() | new.keys() if old.get(row_id) != new.get(row_id)}
+
+def job_signature(job, template_headers, loaded):
+    """模板表头、列映射关系和影响结果的任务配置的哈希，变化时需要全量重建"""
+    settings = {
+        'template_headers': [str(header) for header in template_headers],
+        'key': job['key'],
+        'date_columns': job['date_columns'],
+        'sort_by': job['sort_by'],
+        'sources': [{'name': source['name'], 'key': source.get('key'), 'header_row': source['header_row'],
+                     'headers': [str(header) for header in headers], 'mapping': sorted(mapping.items())}
+                    for source, (headers, _, mapping) in zip(job['sources'], loaded)],
+    }
+    return hashlib.sha256(json.dumps(settings, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def load_state(state_path):
+    """读取上次合并的状态，不存在、损坏或版本不符时返回None"""
+    try:
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    return state if state.get('version') == STATE_VERSION else None
+
+def save_state(state_path, state):
+    """保存合并状态（先写入临时文件再原子替换）"""
+    tmp_file = f"{state_path}.tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, state_path)
+
+def _output_path(output_dir, name):
+    """按当前时间生成输出文件路径，同一秒内已有同名文件时加上序号"""
+    path = os.path.join(output_dir, name.format(timestamp=datetime.now().strftime('%Y%m%d_%H%M%S')))
+    base, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        path = f"{base}_{n}{ext}"
+        n += 1
+    return path
+
+def _write_full_result(job, title_row, merged):
+    """写出完整的结果文件，返回文件路径"""
+    output_path = _output_path(job['output_dir'], job['output_name'])
+    with span('write', rows=len(merged), file=output_path):
+        write_formatted_excel(output_path, title_row, merged.drop(columns=[ROW_ID]), job['image_dir'])
+    print(f"\n生成的合并文件：{os.path.basename(output_path)}（{len(merged)}条记录）")
+    return output_path
+
+async def _format_frames_async(job, frames, value_cache):
+    return await asyncio.gather(*(format_date_columns_async(frame, job['date_columns'], value_cache)
+                                  for frame in frames))
+
+def run_incremental_merge(job, use_async=True, consensus=False, cache=None, value_cache=None,
+                          full_output=False, rebuild=False, state_path=None):
+    """
+    增量执行一个合并任务
+
+    参数：
+        job：任务配置（见merge_engine模块说明）
+        use_async/consensus/cache/value_cache：同run_merge_job
+        full_output：有上次的状态时是否同时重写完整的结果文件
+        rebuild：忽略上次的状态，全量重建
+        state_path：状态文件路径，默认为输出目录下的merge_state.pkl
+
+    返回：
+        本次写出的完整结果文件路径；只写出增量文件时为增量文件路径（只包含本次新增和修改的行）；
+        输入没有变化时为包含所有行的完整结果文件路径（有未合入的增量文件时先重写）；
+        任一来源的映射关系获取失败时返回None
+    """
+    start_time = time.time()
+    job = normalize_job_spec(job)
+    print(f"正在增量合并Excel文件（{len(job['sources'])}个来源）...")
+    cache = cache or MappingCache()
+    value_cache = value_cache or ValueCache()
+    state_path = state_path or os.path.join(job['output_dir'], STATE_NAME)
+
+    template = job['template']
+    with span('read', file=template['path']):
+        title_row, template_headers, _ = load_workbook_table(template['path'], header_row=template['header_row'])
+
+    with span('resolve', sources=len(job['sources']), use_async=use_async, consensus=consensus):
+        loaded = load_sources(job, template_headers, cache, use_async, consensus)
+    for source, (_, _, mapping) in zip(job['sources'], loaded):
+        if not mapping:
+            print(f"获取{source['name']}的列映射关系失败，程序终止")
+            return None
+
+    signature = job_signature(job, template_headers, loaded)
+    state = None if rebuild else load_state(state_path)
+    if state is not None and state['signature'] != signature:
+        print("模板表头、列映射关系或任务配置已变化，全量重建")
+        state = None
+
+    with span('fingerprint') as fingerprint_span:
+        ids, fingerprints = [], []
+        for i, (headers, df, mapping) in enumerate(loaded):
+            source_ids, source_fingerprints = row_fingerprints(
+                df, source_key_column(job, template_headers, i, headers, mapping))
+            ids.append(source_ids)
+            fingerprints.append(source_fingerprints)
+        dirty = None
+        if state is not None:
+            dirty = set().union(*(changed_ids(old, new) for old, new in zip(state['fingerprints'], fingerprints)))
+            fingerprint_span.set(changed=len(dirty))
+
+    if dirty is not None and not dirty:
+        if not state['deltas']:
+            print(f"输入没有新增或修改的行，沿用上次的结果：{state['output']}")
+            return state['output']
+        # 上次的完整结果缺少之后增量文件中的行，用保存的完整结果重写
+        print(f"输入没有新增或修改的行，将{len(state['deltas'])}个增量文件合入完整结果")
+        output_path = _write_full_result(job, title_row, state['frame'])
+        save_state(state_path, dict(state, output=output_path, deltas=[]))
+        return output_path
+
+    # 只构建、格式化和合并指纹变化的行
+    frames = []
+    for i, ((headers, df, mapping), source_ids) in enumerate(zip(loaded, ids)):
+        if dirty is not None:
+            selected = source_ids.isin(dirty).to_numpy()
+            df, ids[i] = df[selected].reset_index(drop=True), source_ids[selected].reset_index(drop=True)
+        frames.append(prepare_frame(job, template_headers, i, headers, df, mapping))
+    if use_async:
+        frames = asyncio.run(_format_frames_async(job, frames, value_cache))
+    else:
+        frames = [format_date_columns(frame, job['date_columns'], value_cache) for frame in frames]
+    delta = join_frames(job, frames)
+    delta[ROW_ID] = ids[0].to_numpy()
+
+    if state is not None:
+        previous = state['frame']
+        kept = previous[~previous[ROW_ID].isin(dirty)]
+        removed = len((set(previous[ROW_ID]) & dirty) - set(delta[ROW_ID]))
+        print(f"新增或修改{delta[ROW_ID].nunique()}个{job['key']}（{len(delta)}行），"
+              f"沿用上次结果中的{len(kept)}行" + (f"，删除{removed}个{job['key']}" if removed > 0 else ""))
+        merged = pd.concat([kept, delta], ignore_index=True)
+    else:
+        print(f"没有可用的上次合并状态，全量合并{len(delta)}行")
+        merged = delta
+    merged = sort_frame(job, merged)
+
+    output_path = state['output'] if state is not None else None
+    deltas = list(state['deltas']) if state is not None else []
+    written = None
+    if state is None or full_output:
+        output_path = written = _write_full_result(job, title_row, merged)
+        deltas = []
+    if state is not None:
+        # 增量文件中的行按完整结果排序，序号与完整结果一致
+        delta_rows = merged[merged[ROW_ID].isin(set(delta[ROW_ID]))]
+        delta_path = _output_path(job['output_dir'], DELTA_NAME)
+        with span('write', rows=len(delta_rows), file=delta_path):
+            write_formatted_excel(delta_path, title_row, delta_rows.drop(columns=[ROW_ID]), job['image_dir'])
+        print(f"\n生成的增量文件：{os.path.basename(delta_path)}（{len(delta_rows)}条记录）")
+        if written is None:
+            written = delta_path
+            deltas.append(delta_path)
+            print(f"完整结果{os.path.basename(output_path)}之后已有{len(deltas)}个增量文件，"
+                  f"使用--full-output（或在输入没有变化时再次运行）重写完整结果")
+
+    save_state(state_path, {
+        'version': STATE_VERSION,
+        'signature': signature,
+        'fingerprints': fingerprints,
+        'frame': merged,
+        'output': output_path,
+        'deltas': deltas,
+        'updated': datetime.now().isoformat(timespec='seconds'),
+    })
+
+    api_stats = get_call_stats()
+    print(f"- AI调用{api_stats['calls']}次（失败{api_stats['failures']}次，重试{api_stats['retries']}次）")
+    cache_stats = value_cache.stats()
+    print(f"- 日期值缓存命中{cache_stats['hits']}次，未命中{cache_stats['misses']}次")
+    print(f"\n增量合并完成！总耗时：{time.time() - start_time:.2f}秒")
+    return written
+
+def _input_snapshot(paths):
+    """各文件的大小和修改时间，文件不存在时为None"""
+    snapshot = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            snapshot[path] = None
+    return snapshot
+
+def watch(spec_path, interval=WATCH_INTERVAL, **kwargs):
+    """
+    监视任务配置和输入文件，发生变化并在一个检查间隔内不再变化（写入完成）后重新增量合并；按Ctrl+C退出
+
+    参数：
+        spec_path：任务配置文件
+        interval：检查间隔（秒）
+        kwargs：传给run_incremental_merge的参数
+    """
+    print(f"正在监视{spec_path}及其输入文件（每{interval}秒检查一次，按Ctrl+C退出）")
+    last_snapshot = None
+    try:
+        while True:
+            try:
+                job = load_job_spec(spec_path)
+            except (OSError, ValueError) as e:
+                print(f"读取任务配置失败：{e}")
+                time.sleep(interval)
+                continue
+            paths = [spec_path, job['template']['path']] + [source['path'] for source in job['sources']]
+            snapshot = _input_snapshot(paths)
+            if snapshot != last_snapshot:
+                time.sleep(interval)
+                if _input_snapshot(paths) != snapshot:
+                    continue
+                last_snapshot = snapshot
+                try:
+                    run_incremental_merge(job, **kwargs)
+                except Exception as e:
+                    print(f"增量合并失败：{type(e).__name__}: {e}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\n已停止监视")
+
+def main():
+    parser = argparse.ArgumentParser(description='增量合并：只处理新增或修改过的行')
+    parser.add_argument('spec', help='任务配置文件（JSON）')
+    parser.add_argument('--watch', action='store_true', help='输入文件变化时自动重新合并')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='监视模式的检查间隔（秒）')
+    parser.add_argument('--full-output', action='store_true', help='同时重写完整的结果文件')
+    parser.add_argument('--rebuild', action='store_true', help='忽略上次的状态，全量重建')
+    parser.add_argument('--sync', action='store_true', help='依次处理各来源（不并发）')
+    parser.add_argument('--consensus', action='store_true', help='使用共识模式获取映射关系')
+    args = parser.parse_args()
+    options = dict(use_async=not args.sync, consensus=args.consensus, full_output=args.full_output)
+    if args.watch:
+        if args.rebuild:
+            run_incremental_merge(load_job_spec(args.spec), rebuild=True, **options)
+        watch(args.spec, args.interval, **options)
+    else:
+        run_incremental_merge(load_job_spec(args.spec), rebuild=args.rebuild, **options)
+
+if __name__ == "__main__":
+    main()
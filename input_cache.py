@@ -0,0 +1,143 @@
+"""
+解析结果的侧车缓存：输入工作簿没有变化时不再用openpyxl重新解析
+
+每个条目由文件的绝对路径、解析参数（如表头行号）决定，保存在缓存目录中：
+- <键>.meta：文件大小、修改时间、内容哈希和小的解析结果（标题行、表头）
+- <键>.feather：数据（安装了pyarrow时，读取时内存映射），无法无损保存为feather时使用<键>.pkl
+
+大小和修改时间都没变时直接使用缓存；修改时间变化但大小相同时比较内容哈希，
+内容相同（如重新复制）仍然使用缓存；其余情况重新解析并覆盖缓存条目。
+
+通过环境变量AIEXCEL_INPUT_CACHE设置缓存目录（默认为.input_cache），设置为空时关闭缓存。
+"""
+import hashlib
+import json
+import os
+import pickle
+import pandas as pd
+from signature_thumbs import file_hash
+
+try:
+    import pyarrow.feather as feather
+except ImportError:  # 没有安装pyarrow时数据以pickle保存
+    feather = None
+
+CACHE_DIR = os.getenv('AIEXCEL_INPUT_CACHE', '.input_cache')
+
+# 解析规则变化时增加版本号，使旧的缓存条目失效
+CACHE_VERSION = 1
+
+def _entry_key(kind, file_path, params):
+    raw = json.dumps([CACHE_VERSION, kind, os.path.abspath(file_path), params], ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def _atomic_write(path, write):
+    """先写入临时文件再原子替换，多个进程同时写入同一条目时不会留下不完整的文件"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+def _feather_compatible(df):
+    """
+    数据能否无损保存为feather：列名为不重复的文本、使用默认索引，且每列都是数值、日期（无时区）
+    或只含文本的列。一列中混有日期和文本等情况feather会改变值的类型，改用pickle。
+    """
+    if not df.columns.is_unique or not all(isinstance(column, str) for column in df.columns):
+        return False
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        return False
+    for _, column in df.items():
+        dtype = column.dtype
+        if dtype == object:
+            if pd.api.types.infer_dtype(column, skipna=True) not in ('string', 'empty'):
+                return False
+        elif not (pd.api.types.is_string_dtype(dtype) or pd.api.types.is_datetime64_dtype(dtype)
+                  or (pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_complex_dtype(dtype))):
+            return False
+    return True
+
+def _write_frame(df, base_path):
+    """
+    保存数据，返回数据文件路径
+
+    能无损保存时（见_feather_compatible）保存为未压缩的feather（可以内存映射读取），否则改用pickle。
+    """
+    if feather is not None and _feather_compatible(df):
+        path = f"{base_path}.feather"
+        try:
+            _atomic_write(path, lambda f: feather.write_feather(df, f, compression='uncompressed'))
+            return path
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+    path = f"{base_path}.pkl"
+    _atomic_write(path, lambda f: pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL))
+    return path
+
+def _read_frame(path):
+    if path.endswith('.feather'):
+        return feather.read_table(path, memory_map=True).to_pandas()
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def cached_parse(kind, file_path, params, parse, cache_dir=None):
+    """
+    返回文件的解析结果，缓存有效时直接读取侧车文件，否则调用parse解析并写入缓存
+
+    参数：
+        kind：解析类型（如"table"、"headers"），与params一起区分同一文件的不同条目
+        file_path：输入文件路径
+        params：影响解析结果的参数（可JSON序列化）
+        parse：无参数的解析函数，返回(info, df)：info为小的解析结果，df为DataFrame或None
+        cache_dir：缓存目录，默认为AIEXCEL_INPUT_CACHE
+
+    返回：
+        (info, df)
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return parse()
+
+    key = _entry_key(kind, file_path, params)
+    meta_path = os.path.join(cache_dir, f"{key}.meta")
+    stat = os.stat(file_path)
+    meta = _read_meta(meta_path)
+    if meta is not None and (meta['size'], meta['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+        if meta['size'] == stat.st_size and file_hash(file_path) == meta['content_hash']:
+            # 只有修改时间变化，记录新的修改时间，下次不再计算哈希
+            meta['mtime_ns'] = stat.st_mtime_ns
+            _atomic_write(meta_path, lambda f: pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL))
+        else:
+            meta = None
+    if meta is not None:
+        try:
+            return meta['info'], _read_frame(os.path.join(cache_dir, meta['frame'])) if meta['frame'] else None
+        except Exception:
+            # 数据文件丢失或损坏，重新解析
+            pass
+
+    # 先取文件状态和内容哈希再解析，解析期间文件被修改时下次会重新解析
+    content_hash = file_hash(file_path)
+    info, df = parse()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        frame_path = _write_frame(df, os.path.join(cache_dir, key)) if df is not None else None
+        meta = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'content_hash': content_hash, 'info': info,
+                'frame': os.path.basename(frame_path) if frame_path else None}
+        _atomic_write(meta_path, lambda f: pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception as e:
+        print(f"写入解析缓存出错：{str(e)}")
+    return info, df
@@ -1,80 +1,232 @@
+import hashlib
 import json
-import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Any, Iterable, Iterator, List, Dict, Optional, Tuple
+
+class LRUCache:
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600):
+        """
+        Initialize in-memory LRU cache
+
+        Args:
+            max_entries: Maximum number of entries, least recently used entries are evicted first
+            ttl: Seconds an entry stays valid, None to keep entries until evicted
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a value, None if missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, stored_at = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """Store a value, evicting the least recently used entries when full"""
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all entries"""
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit, miss, eviction and expiration counts"""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'size': len(self.entries)}
 
 class MappingCache:
-    def __init__(self, cache_file: str = 'header_mappings_cache.json'):
-        """Initialize mapping cache"""
+    def __init__(self, cache_file: str = 'header_mappings_cache.db',
+                 memory_size: int = 1024, memory_ttl: Optional[float] = 3600):
+        """
+        Initialize mapping cache
+
+        Args:
+            cache_file: SQLite database storing the mappings
+            memory_size: Maximum number of mappings kept in the in-memory tier
+            memory_ttl: Seconds a mapping stays in the in-memory tier
+        """
         self.cache_file = cache_file
-        self.cache = self._load_cache()
+        self.memory = LRUCache(memory_size, memory_ttl)
+        self._init_db()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open an autocommit connection, closed on exit
 
-    def _load_cache(self) -> Dict:
-        """Load cache from file"""
+        Every statement commits atomically; concurrent writers from other
+        processes wait for the database lock instead of failing.
+        """
+        conn = sqlite3.connect(self.cache_file, timeout=30, isolation_level=None)
         try:
-            if os.path.exists(self.cache_file):
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
-        except Exception as e:
-            print(f"Error loading cache: {str(e)}")
-            return {}
+            yield conn
+        finally:
+            conn.close()
 
-    def _save_cache(self) -> None:
-        """Save cache to file"""
+    def _init_db(self) -> None:
+        """Create the schema"""
         try:
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(self.cache, f, ensure_ascii=False, indent=2)
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS mappings (
+                        cache_key TEXT NOT NULL,
+                        mapping_type TEXT NOT NULL,
+                        mapping TEXT NOT NULL,
+                        last_updated TEXT NOT NULL,
+                        PRIMARY KEY (cache_key, mapping_type)
+                    )""")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS header_pairs (
+                        mapping_type TEXT NOT NULL,
+                        source_header TEXT NOT NULL,
+                        target_header TEXT NOT NULL,
+                        confirmations INTEGER NOT NULL DEFAULT 1,
+                        last_updated TEXT NOT NULL,
+                        PRIMARY KEY (mapping_type, source_header, target_header)
+                    )""")
         except Exception as e:
-            print(f"Error saving cache: {str(e)}")
+            print(f"Error initializing cache: {str(e)}")
 
-    def _generate_cache_key(self, headers1: List[str], headers2: List[str]) -> str:
-        """Generate unique cache key for header pairs"""
-        # Sort headers to ensure consistent key generation
-        sorted_headers1 = sorted(headers1)
-        sorted_headers2 = sorted(headers2)
-        return f"{','.join(sorted_headers1)}|{','.join(sorted_headers2)}"
+    def _generate_cache_key(self, headers1: List[str], headers2: List[str], mapping_type: str) -> str:
+        """
+        Generate unique cache key for header pairs
+
+        The key is an MD5 digest of both header lists in their original
+        order plus the mapping type, because cached mappings are positional.
+        """
+        key_data = json.dumps([list(headers1), list(headers2), mapping_type],
+                              ensure_ascii=False, default=str)
+        return hashlib.md5(key_data.encode('utf-8')).hexdigest()
 
     def get_mapping(self, headers1: List[str], headers2: List[str], mapping_type: str) -> Optional[Dict[int, int]]:
         """
         Get mapping from cache
-        
+
         Args:
             headers1: First table headers
             headers2: Second table headers
             mapping_type: Type of mapping (e.g., "1_to_2", "1_to_3")
         """
-        cache_key = self._generate_cache_key(headers1, headers2)
-        if cache_key in self.cache and mapping_type in self.cache[cache_key]:
-            mapping_data = self.cache[cache_key][mapping_type]
-            # Convert string keys back to integers
-            return {int(k): int(v) for k, v in mapping_data.items()}
-        return None
-
-    def save_mapping(self, headers1: List[str], headers2: List[str], 
-                    mapping_type: str, mapping: Dict[int, int]) -> None:
+        cache_key = self._generate_cache_key(headers1, headers2, mapping_type)
+        mapping = self.memory.get(cache_key)
+        if mapping is not None:
+            return dict(mapping)
+
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT mapping FROM mappings WHERE cache_key = ? AND mapping_type = ?',
+                    (cache_key, mapping_type)).fetchone()
+        except Exception as e:
+            print(f"Error loading cache: {str(e)}")
+            return None
+        if row is None:
+            return None
+        # Convert string keys back to integers
+        mapping = {int(k): int(v) for k, v in json.loads(row[0]).items()}
+        self.memory.put(cache_key, mapping)
+        return dict(mapping)
+
+    def save_mapping(self, headers1: List[str], headers2: List[str],
+                    mapping_type: str, mapping: Dict[int, int],
+                    confirmed: Optional[Iterable[int]] = None) -> None:
         """
         Save mapping to cache
-        
+
         Args:
             headers1: First table headers
             headers2: Second table headers
             mapping_type: Type of mapping (e.g., "1_to_2", "1_to_3")
             mapping: Dictionary containing the mapping relationships
+            confirmed: Second table columns whose pairs were confirmed by the AI or a user;
+                only these are recorded as header pairs for the similarity index.
+                None records every pair of the mapping.
         """
-        cache_key = self._generate_cache_key(headers1, headers2)
-        if cache_key not in self.cache:
-            self.cache[cache_key] = {}
-        
+        cache_key = self._generate_cache_key(headers1, headers2, mapping_type)
+        self.memory.put(cache_key, {int(k): int(v) for k, v in mapping.items()})
+
         # Convert all keys and values to strings for JSON serialization
         mapping_data = {str(k): str(v) for k, v in mapping.items()}
-        
-        self.cache[cache_key][mapping_type] = mapping_data
-        self.cache[cache_key]['last_updated'] = datetime.now().isoformat()
-        
-        self._save_cache()
+
+        # Confirmed header name pairs (second table header -> first table header)
+        now = datetime.now().isoformat()
+        confirmed = set(mapping) if confirmed is None else set(confirmed)
+        pairs = [(mapping_type, str(headers2[k]), str(headers1[v]), now) for k, v in mapping.items()
+                 if k in confirmed and 0 <= k < len(headers2) and 0 <= v < len(headers1)]
+
+        try:
+            with self._connect() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute("""
+                        INSERT INTO mappings (cache_key, mapping_type, mapping, last_updated)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (cache_key, mapping_type)
+                        DO UPDATE SET mapping = excluded.mapping, last_updated = excluded.last_updated""",
+                        (cache_key, mapping_type, json.dumps(mapping_data, ensure_ascii=False), now))
+                    conn.executemany("""
+                        INSERT INTO header_pairs (mapping_type, source_header, target_header, last_updated)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (mapping_type, source_header, target_header)
+                        DO UPDATE SET confirmations = confirmations + 1, last_updated = excluded.last_updated""",
+                        pairs)
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+        except Exception as e:
+            print(f"Error saving cache: {str(e)}")
+
+    def get_header_pairs(self) -> List[Tuple[str, str, int]]:
+        """
+        Get all confirmed header pairs
+
+        Returns:
+            List of (source header, target header, confirmation count)
+        """
+        try:
+            with self._connect() as conn:
+                return conn.execute("""
+                    SELECT source_header, target_header, SUM(confirmations)
+                    FROM header_pairs GROUP BY source_header, target_header""").fetchall()
+        except Exception as e:
+            print(f"Error loading header pairs: {str(e)}")
+            return []
+
+    def stats(self) -> Dict[str, int]:
+        """Return statistics of the in-memory tier"""
+        return self.memory.stats()
 
     def clear_cache(self) -> None:
         """Clear all cache"""
-        self.cache = {}
-        self._save_cache()
+        self.memory.clear()
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM mappings')
+                conn.execute('DELETE FROM header_pairs')
+        except Exception as e:
+            print(f"Error clearing cache: {str(e)}")
@@ -0,0 +1,326 @@
+"""
+按任务配置合并任意数量的来源表
+
+任务配置（JSON）示例：
+{
+    "template": {"path": "模板.xlsx", "header_row": 1},
+    "key": "学号",
+    "sources": [
+        {"path": "问卷.xlsx", "key": "请输入你的学号（必填）"},
+        {"path": "教务数据.xlsx", "header_row": 1},
+        {"path": "宿舍信息.xlsx", "header_row": 1, "key": "学生学号"}
+    ],
+    "date_columns": ["离校时间", "返校时间"],
+    "image_dir": "签名",
+    "output_dir": "."
+}
+
+第一个来源为主表，结果的每一行来自主表；之后的来源按连接键补充或覆盖对应列，靠后的来源优先。
+各来源的key为其连接键列名，省略时使用映射到模板连接键的列。
+配置中的相对路径相对于配置文件所在目录。
+
+使用方法：
+    python merge_engine.py merge_job.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+from ai_client import get_call_stats
+from mapping_cache import MappingCache
+from value_cache import ValueCache
+from workbook_loader import load_workbook_table
+from tracing import current_span, span
+from merge_excel import (DATE_COLUMNS, build_merged_frame, format_date_columns, format_date_columns_async,
+                         normalize_student_ids, resolve_column_mapping, resolve_column_mapping_async,
+                         write_formatted_excel)
+
+DEFAULT_KEY = '学号'
+OUTPUT_NAME = 'Merged_result_{timestamp}.xlsx'
+
+# 来源文件总大小达到该字节数时用多进程并行解析，否则在线程中解析
+LOAD_POOL_THRESHOLD = 1 << 20
+
+# 设置为1时始终在线程中解析（批量合并的工作进程中设置，避免再嵌套创建进程池）
+LOAD_THREADS_ENV = 'AIEXCEL_LOAD_THREADS'
+
+def load_job_spec(spec_path):
+    """读取任务配置文件，相对路径按配置文件所在目录解析"""
+    with open(spec_path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    return normalize_job_spec(spec, os.path.dirname(os.path.abspath(spec_path)))
+
+def normalize_job_spec(spec, base_dir='.'):
+    """补全任务配置的默认值，并将路径转换为绝对路径"""
+    def resolve(path):
+        return path if path is None or os.path.isabs(path) else os.path.join(base_dir, path)
+
+    if not spec.get('sources'):
+        raise ValueError("任务配置中至少需要一个来源表（sources）")
+    job = dict(spec)
+    job['template'] = dict(spec['template'], path=resolve(spec['template']['path']))
+    job['template'].setdefault('header_row', 0)
+    job['key'] = spec.get('key', DEFAULT_KEY)
+    job['date_columns'] = spec.get('date_columns', DATE_COLUMNS)
+    job['image_dir'] = resolve(spec.get('image_dir'))
+    job['output_dir'] = resolve(spec.get('output_dir')) or os.path.dirname(job['template']['path'])
+    job['output_name'] = spec.get('output_name', OUTPUT_NAME)
+    job['sort_by'] = spec.get('sort_by', job['key'])
+
+    sources = []
+    for i, source in enumerate(spec['sources']):
+        source = dict(source, path=resolve(source['path']))
+        source.setdefault('name', os.path.splitext(os.path.basename(source['path']))[0])
+        source.setdefault('header_row', 0)
+        # 连接键按文本读取，避免学号被解析为数字
+        source.setdefault('str_columns', [source['key']] if source.get('key') else [])
+        # 与merge_excel_files使用的缓存类型一致：第一个来源为“1_to_2”，第二个为“1_to_3”，依此类推
+        source.setdefault('mapping_type', f"1_to_{i + 2}")
+        sources.append(source)
+    job['sources'] = sources
+    return job
+
+def project_source(template_headers, df, headers, mapping, key, key_column=None):
+    """
+    按映射关系将来源表的列重命名为模板列名
+
+    返回：
+        只包含映射列的DataFrame；key_column指定的来源列作为连接键列（列名为key）
+    """
+    columns = {template_headers[idx1]: df[headers[idx2]] for idx2, idx1 in mapping.items()}
+    if key_column is not None and key_column in df.columns:
+        columns[key] = df[key_column]
+    return pd.DataFrame(columns, index=df.index)
+
+def join_sources(base, sources, key):
+    """
+    按连接键一次性合并多个来源表
+
+    每个模板列只做一次哈希查找：所有包含该列的来源按顺序连接，同一个键取最后出现的行
+    （靠后的来源、来源内靠后的行优先），匹配到的行整体覆盖主表的值，未匹配的行保留原值。
+
+    参数：
+        base：按模板结构构建的主表
+        sources：[(来源名称, project_source得到的DataFrame)] 列表
+        key：连接键（模板中的列名）
+
+    返回：
+        合并后的DataFrame
+    """
+    if key not in base.columns:
+        print(f"模板中没有连接键列{key}，跳过其他来源的合并")
+        return base
+
+    keys = normalize_student_ids(base[key])
+    lookups = []
+    for name, frame in sources:
+        if key not in frame.columns:
+            print(f"{name}中没有找到连接键列，跳过该来源")
+            continue
+        lookup = frame.drop(columns=[key])
+        lookup.index = normalize_student_ids(frame[key])
+        lookup = lookup[lookup.index.notna()]
+        duplicated = lookup.index.duplicated(keep='last')
+        if duplicated.any():
+            duplicate_ids = lookup.index[duplicated].unique().tolist()
+            print(f"{name}中有{len(duplicate_ids)}个重复{key}（以最后一行为准）：{duplicate_ids[:10]}")
+            lookup = lookup[~duplicated]
+        matched = keys.isin(lookup.index)
+        unmatched_ids = lookup.index[~lookup.index.isin(keys.dropna())].tolist()
+        print(f"{name}匹配到{int(matched.sum())}/{len(base)}行")
+        if unmatched_ids:
+            print(f"{name}中有{len(unmatched_ids)}个{key}在结果表中不存在：{unmatched_ids[:10]}")
+        current_span().set(**{f"matched.{name}": int(matched.sum())})
+        lookups.append(lookup)
+
+    columns = list(dict.fromkeys(col for lookup in lookups for col in lookup.columns))
+    for col in columns:
+        parts = [lookup[col] for lookup in lookups if col in lookup.columns]
+        combined = parts[0] if len(parts) == 1 else pd.concat(parts)
+        combined = combined[~combined.index.duplicated(keep='last')]
+        present = keys.isin(combined.index).to_numpy()
+        base[col] = base[col].where(~present, keys.map(combined))
+    return base
+
+def _load_executor(job):
+    """来源文件较大时用进程池并行解析，否则（或设置了AIEXCEL_LOAD_THREADS=1时）用线程池"""
+    paths = [source['path'] for source in job['sources']]
+    total_size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    workers = min(len(paths), os.cpu_count() or 1)
+    force_threads = os.getenv(LOAD_THREADS_ENV) == '1'
+    if not force_threads and len(paths) > 1 and total_size >= LOAD_POOL_THRESHOLD and workers > 1:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=len(paths))
+
+def source_key_column(job, template_headers, i, headers, mapping):
+    """来源表中的连接键列名：配置中的key，省略时为映射到模板连接键的列"""
+    key_column = job['sources'][i].get('key')
+    if key_column is None:
+        key_column = next((headers[idx2] for idx2, idx1 in mapping.items() if template_headers[idx1] == job['key']),
+                          None)
+    return key_column
+
+def prepare_frame(job, template_headers, i, headers, df, mapping):
+    """将来源表转换为按模板列命名的DataFrame，主表按模板结构构建"""
+    if i == 0:
+        return build_merged_frame(template_headers, df, headers, mapping)
+    key_column = source_key_column(job, template_headers, i, headers, mapping)
+    return project_source(template_headers, df, headers, mapping, job['key'], key_column)
+
+async def _load_source_async(job, template_headers, i, executor, cache, consensus):
+    """读取一个来源表并获取映射关系"""
+    source = job['sources'][i]
+    loop = asyncio.get_running_loop()
+    with span('read', file=source['path']) as read_span:
+        _, headers, df = await loop.run_in_executor(executor, load_workbook_table, source['path'],
+                                                    source['header_row'], source['str_columns'])
+        read_span.set(rows=len(df))
+    mapping = await resolve_column_mapping_async(cache, template_headers, headers, source['mapping_type'],
+                                                 is_comparing_1_and_3=i > 0, consensus=consensus)
+    return headers, df, mapping
+
+def _load_source(job, template_headers, i, cache, consensus):
+    """_load_source_async的同步版本"""
+    source = job['sources'][i]
+    with span('read', file=source['path']) as read_span:
+        _, headers, df = load_workbook_table(source['path'], source['header_row'], source['str_columns'])
+        read_span.set(rows=len(df))
+    mapping = resolve_column_mapping(cache, template_headers, headers, source['mapping_type'],
+                                     is_comparing_1_and_3=i > 0, consensus=consensus)
+    return headers, df, mapping
+
+async def _prepare_source_async(job, template_headers, i, executor, cache, value_cache, consensus):
+    """读取一个来源表、获取映射关系并统一日期格式；各来源同时进行"""
+    headers, df, mapping = await _load_source_async(job, template_headers, i, executor, cache, consensus)
+    if not mapping:
+        return None
+    frame = prepare_frame(job, template_headers, i, headers, df, mapping)
+    return await format_date_columns_async(frame, job['date_columns'], value_cache)
+
+def _prepare_source(job, template_headers, i, cache, value_cache, consensus):
+    """_prepare_source_async的同步版本"""
+    headers, df, mapping = _load_source(job, template_headers, i, cache, consensus)
+    if not mapping:
+        return None
+    frame = prepare_frame(job, template_headers, i, headers, df, mapping)
+    return format_date_columns(frame, job['date_columns'], value_cache)
+
+async def _prepare_sources_async(job, template_headers, cache, value_cache, consensus):
+    with _load_executor(job) as executor:
+        return await asyncio.gather(*(
+            _prepare_source_async(job, template_headers, i, executor, cache, value_cache, consensus)
+            for i in range(len(job['sources']))))
+
+async def _load_sources_async(job, template_headers, cache, consensus):
+    with _load_executor(job) as executor:
+        return await asyncio.gather(*(
+            _load_source_async(job, template_headers, i, executor, cache, consensus)
+            for i in range(len(job['sources']))))
+
+def load_sources(job, template_headers, cache, use_async=True, consensus=False):
+    """
+    读取所有来源表并获取映射关系（不构建结果、不统一日期格式）
+
+    返回：
+        [(表头, DataFrame, 映射关系)] 列表，与job['sources']的顺序一致
+    """
+    if use_async:
+        return asyncio.run(_load_sources_async(job, template_headers, cache, consensus))
+    return [_load_source(job, template_headers, i, cache, consensus) for i in range(len(job['sources']))]
+
+def join_frames(job, frames):
+    """将其他来源按连接键合并到主表（frames[0]）"""
+    new_df, others = frames[0], frames[1:]
+    if others:
+        print("\n合并其他来源的数据...")
+        with span('join', rows=len(new_df), sources=len(others)):
+            new_df = join_sources(new_df, [(source['name'], frame)
+                                           for source, frame in zip(job['sources'][1:], others)], job['key'])
+    return new_df
+
+def sort_frame(job, df):
+    """按sort_by排序（相同值保持原有顺序）并重新生成序号"""
+    sort_by = job['sort_by']
+    if sort_by in df.columns:
+        with span('sort', rows=len(df)):
+            df = df.sort_values(sort_by, kind='stable')
+            if '序号' in df.columns:
+                df['序号'] = range(1, len(df) + 1)
+    return df
+
+def run_merge_job(job, use_async=True, consensus=False, cache=None, value_cache=None):
+    """
+    执行一个合并任务
+
+    参数：
+        job：任务配置（见模块说明），可以是load_job_spec的结果或未补全默认值的字典
+        use_async：是否同时读取各来源并并发获取映射关系
+        consensus：是否使用共识模式获取映射关系
+        cache/value_cache：映射缓存和值缓存，默认使用当前目录下的缓存文件
+
+    返回：
+        输出文件路径，任一来源的映射关系获取失败时返回None
+    """
+    start_time = time.time()
+    job = normalize_job_spec(job)
+    print(f"正在合并Excel文件（{len(job['sources'])}个来源）...")
+    cache = cache or MappingCache()
+    value_cache = value_cache or ValueCache()
+
+    template = job['template']
+    with span('read', file=template['path']):
+        title_row, template_headers, _ = load_workbook_table(template['path'], header_row=template['header_row'])
+
+    # 各来源的读取、映射和日期格式化同时进行
+    with span('resolve', sources=len(job['sources']), use_async=use_async, consensus=consensus):
+        if use_async:
+            frames = asyncio.run(_prepare_sources_async(job, template_headers, cache, value_cache, consensus))
+        else:
+            frames = [_prepare_source(job, template_headers, i, cache, value_cache, consensus)
+                      for i in range(len(job['sources']))]
+    for source, frame in zip(job['sources'], frames):
+        if frame is None:
+            print(f"获取{source['name']}的列映射关系失败，程序终止")
+            return None
+
+    new_df = sort_frame(job, join_frames(job, frames))
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_filename = job['output_name'].format(timestamp=timestamp)
+    output_path = os.path.join(job['output_dir'], output_filename)
+
+    # 一次写出带格式的结果文件（处理签名图片，假设签名在最后一列）
+    with span('write', rows=len(new_df), file=output_path):
+        write_formatted_excel(output_path, title_row, new_df, job['image_dir'])
+
+    print(f"\n生成的合并文件：{output_filename}")
+    print(f"包含{len(new_df)}条记录")
+    print("应用了格式化：")
+    print("- 保留了原始表的第一行和合并单元格")
+    print("- 居中对齐了所有单元格")
+    print(f"- 合并了{len(job['sources'])}个来源的数据")
+    print("- 添加了细边框到所有单元格")
+    print("- 将学号列设置为文本格式以避免科学计数法")
+    print("- 统一了日期格式为mm.dd")
+    api_stats = get_call_stats()
+    print(f"- AI调用{api_stats['calls']}次（失败{api_stats['failures']}次，重试{api_stats['retries']}次），"
+          f"平均耗时{api_stats['avg_latency']:.2f}秒，合并相同请求{api_stats['coalesced']}次")
+    cache_stats = value_cache.stats()
+    print(f"- 日期值缓存命中{cache_stats['hits']}次，未命中{cache_stats['misses']}次")
+    print(f"\nExcel合并完成！总耗时：{time.time() - start_time:.2f}秒")
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description='按任务配置合并多个Excel文件')
+    parser.add_argument('spec', help='任务配置文件（JSON）')
+    parser.add_argument('--sync', action='store_true', help='依次处理各来源（不并发）')
+    parser.add_argument('--consensus', action='store_true', help='使用共识模式获取映射关系')
+    args = parser.parse_args()
+    run_merge_job(load_job_spec(args.spec), use_async=not args.sync, consensus=args.consensus)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import pandas as pd
 import os
-import time
-from datetime import datetime
-from openai import OpenAI
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import openpyxl
-from openpyxl.styles import Alignment, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, Side
 from openpyxl.utils import get_column_letter
-from compare_headers import read_excel_headers, compare_headers_with_ai
-from mapping_cache import MappingCache
+from ai_client import achat_completion, chat_completion
+from compare_headers import (CONSENSUS_MIN_AGREEMENT, acompare_headers_consensus, acompare_headers_with_ai,
+                             compare_headers_with_ai, parse_ai_response)
+from date_normalizer import parse_dates_locally
+from signature_index import SignatureIndex
+from signature_thumbs import make_thumbnails
+from header_matcher import columns_for_ai, match_headers
+from header_index import HeaderSimilarityIndex
+from tracing import current_span, span
 
 # 特殊列配置
 SPECIAL_COLUMNS = {
@@ -15,15 +23,139 @@ SPECIAL_COLUMNS = {
     'signature': -1,  # 签名列（最后一列）
 }
 
-def format_date_with_ai(dates):
-    # 初始化API客户端
-    client = OpenAI(
-        api_key="***",
-        base_url="***"
-    )
+# 需要统一为mm.dd格式的日期列
+DATE_COLUMNS = ['离校时间', '返校时间']
 
+# AI日期格式化：每次请求的最大日期数和同时进行的最大请求数
+DATE_CHUNK_SIZE = 100
+DATE_MAX_CONCURRENCY = 4
+
+# 日期格式化提示词版本，修改提示词后需更新，使旧的缓存结果失效
+DATE_NORMALIZER = 'date_mmdd'
+DATE_PROMPT_VERSION = 'v1'
+
+def format_date_columns(df, columns, value_cache=None):
+    """统一多个日期列的格式，所有列的值合并去重后一起处理"""
+    columns = [col for col in columns if col in df.columns]
+    if not columns:
+        return df
+    
+    with span('date', rows=len(df), columns=len(columns)):
+        formatted = format_date_with_ai(_stack_columns(df, columns), value_cache)
+        return _unstack_columns(df, columns, formatted)
+
+async def format_date_columns_async(df, columns, value_cache=None):
+    """format_date_columns的异步版本"""
+    columns = [col for col in columns if col in df.columns]
+    if not columns:
+        return df
+    
+    with span('date', rows=len(df), columns=len(columns)):
+        formatted = await format_date_with_ai_async(_stack_columns(df, columns), value_cache)
+        return _unstack_columns(df, columns, formatted)
+
+def _stack_columns(df, columns):
+    """将多列的值依次连接为一个列表"""
+    return [d for col in columns for d in df[col].tolist()]
+
+def _unstack_columns(df, columns, values):
+    """将_stack_columns连接的列表按列拆分写回"""
+    for i, col in enumerate(columns):
+        df[col] = values[i * len(df):(i + 1) * len(df)]
+    return df
+
+def format_date_with_ai(dates, value_cache=None):
+    """
+    将日期统一转换为mm.dd格式
+    
+    先在本地解析，本地无法解析的值再查询值缓存，仍未命中的才交给AI处理。
+    发送给AI的值先去重并编号，结果按编号对应回原始值，再按值填回每一行。
+    """
+    formatted, results, pending = prepare_date_formatting(dates, value_cache)
+    if pending:
+        save_date_results(request_date_formatting(pending), results, value_cache)
+    return apply_date_results(dates, formatted, results)
+
+async def format_date_with_ai_async(dates, value_cache=None):
+    """format_date_with_ai的异步版本"""
+    formatted, results, pending = prepare_date_formatting(dates, value_cache)
+    if pending:
+        save_date_results(await request_date_formatting_async(pending), results, value_cache)
+    return apply_date_results(dates, formatted, results)
+
+def prepare_date_formatting(dates, value_cache=None):
+    """
+    在本地解析日期并查询值缓存
+    
+    返回：
+        (formatted, results, pending)：本地解析结果、缓存命中的结果、仍需交给AI的去重后的值
+    """
+    formatted = parse_dates_locally(dates)
+    pending = list(dict.fromkeys(d for d, f in zip(dates, formatted) if f is None))
+    results = {}
+    if pending and value_cache is not None:
+        results = value_cache.get_many(DATE_NORMALIZER, DATE_PROMPT_VERSION, pending)
+        pending = [d for d in pending if d not in results]
+    current_span().set(values=len(dates), cache_hits=len(results), cache_misses=len(pending))
+    if pending:
+        print(f"有{len(pending)}个日期无法在本地解析，使用AI处理...")
+    return formatted, results, pending
+
+def save_date_results(ai_results, results, value_cache=None):
+    """将AI返回的结果加入results并写入值缓存"""
+    if value_cache is not None:
+        value_cache.save_many(DATE_NORMALIZER, DATE_PROMPT_VERSION, ai_results)
+    results.update(ai_results)
+
+def apply_date_results(dates, formatted, results):
+    """按值填回本地无法解析的日期，仍没有结果或AI也无法解析（空字符串）的保留原值"""
+    return [(results.get(d) or str(d)) if f is None else f
+            for d, f in zip(dates, formatted)]
+
+def _date_chunks(values):
+    """将值按DATE_CHUNK_SIZE分块"""
+    chunks = [values[i:i + DATE_CHUNK_SIZE] for i in range(0, len(values), DATE_CHUNK_SIZE)]
+    print(f"正在统一日期格式（共{len(chunks)}个请求）...")
+    return chunks
+
+def request_date_formatting(values):
+    """
+    调用AI转换无法在本地解析的日期
+    
+    值按DATE_CHUNK_SIZE分块，最多DATE_MAX_CONCURRENCY个请求同时进行，
+    耗时只随不同值的数量增长。
+    
+    参数：
+        values：去重后的原始日期值列表
+        
+    返回：
+        原始值到mm.dd字符串的字典；AI明确表示无法解析的值对应空字符串，
+        AI没有返回的值和调用失败的分块不包含在结果中
+    """
+    chunks = _date_chunks(values)
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(DATE_MAX_CONCURRENCY, len(chunks))) as executor:
+        for chunk_results in executor.map(request_date_chunk, chunks):
+            results.update(chunk_results)
+    return results
+
+async def request_date_formatting_async(values):
+    """request_date_formatting的异步版本，用信号量限制同时进行的请求数"""
+    semaphore = asyncio.Semaphore(DATE_MAX_CONCURRENCY)
+    
+    async def request(chunk):
+        async with semaphore:
+            return await request_date_chunk_async(chunk)
+    
+    results = {}
+    for chunk_results in await asyncio.gather(*(request(chunk) for chunk in _date_chunks(values))):
+        results.update(chunk_results)
+    return results
+
+def build_date_messages(values):
+    """构建一个分块的日期格式化请求消息，日期按分块内的编号对应"""
     # 构建提示信息
-    dates_str = "\n".join([f"{i+1}. {d}" for i, d in enumerate(dates) if pd.notna(d)])
+    dates_str = "\n".join([f"{i+1}. {d}" for i, d in enumerate(values)])
     prompt = f"""请将以下日期统一转换为mm.dd格式（月份和日期都用两位数表示，中间用点分隔）。
 如果日期明显错误或无法解析，请返回空字符串。
 示例：
@@ -35,252 +167,323 @@ def format_date_with_ai(dates):
 需要转换的日期：
 {dates_str}
 
-请按照以下格式返回结果，每行一个日期：
-01.07
-02.15
+请按照以下格式返回结果，每行一个日期，保留原来的编号：
+1. 01.07
+2. 02.15
 ...
-只返回转换后的日期，不要有任何解释性文字。对于空值或无法解析的日期，返回空行。"""
+只返回编号和转换后的日期，不要有任何解释性文字。对于无法解析的日期，编号后留空。"""
+    return [
+        {"role": "system", "content": "你是一个专门处理日期格式的助手。请直接返回格式化后的日期，不要返回其他内容。"},
+        {"role": "user", "content": prompt}
+    ]
 
+def request_date_chunk(values):
+    """发送一个分块的日期格式化请求"""
     try:
-        print("正在统一日期格式...")
-        response = client.chat.completions.create(
-            model="***",
-            messages=[
-                {"role": "system", "content": "你是一个专门处理日期格式的助手。请直接返回格式化后的日期，不要返回其他内容。"},
-                {"role": "user", "content": prompt}
-            ],
-            stream=True
-        )
-
-        # 收集完整的响应
-        full_response = ""
-        for chunk in response:
-            if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
-                content = chunk.choices[0].delta.content
-                full_response += content
-
-        # 解析返回的日期
-        formatted_dates = full_response.strip().split('\n')
-        
-        # 创建结果列表，保持原始数据的空值
-        result = []
-        formatted_idx = 0
-        for original_date in dates:
-            if pd.isna(original_date):
-                result.append('')
-            else:
-                if formatted_idx < len(formatted_dates):
-                    result.append(formatted_dates[formatted_idx].strip())
-                    formatted_idx += 1
-                else:
-                    result.append('')
-        
-        return result
+        full_response = chat_completion(messages=build_date_messages(values), stream=True, label="format_dates")
+        return parse_date_response(full_response, values)
     except Exception as e:
         print(f"日期格式化错误：{str(e)}")
-        return dates
+        return {}
 
-def parse_ai_response(response_text):
-    """解析AI响应文本，转换为字典映射"""
-    mapping = {}
+async def request_date_chunk_async(values):
+    """request_date_chunk的异步版本"""
+    try:
+        full_response = await achat_completion(messages=build_date_messages(values), stream=True, label="format_dates")
+        return parse_date_response(full_response, values)
+    except Exception as e:
+        print(f"日期格式化错误：{str(e)}")
+        return {}
+
+def parse_date_response(response_text, values):
+    """
+    按编号解析AI返回的日期
+
+    只返回AI实际给出的编号：编号后为mm.dd的取该日期，编号后明确留空的（无法解析）对应空字符串；
+    缺失的编号（如被跳过或输出被截断）和格式不正确的不在结果中，不会写入缓存，下次重新处理。
+    """
+    results = {}
     for line in response_text.strip().split('\n'):
-        if '对应' in line:
-            parts = line.replace('。', '').split('对应')
-            table1_part = parts[0].strip()
-            table2_part = parts[1].strip()
-            
-            # 提取索引
-            idx1 = int(table1_part.split('的')[1]) - 1
-            idx2 = int(table2_part.split('的')[1]) - 1
-            
-            # 创建映射关系（从table2到table1）
-            mapping[idx2] = idx1
-    return mapping
+        match = re.match(r'^\s*(\d+)\s*[.、:：)）](.*)$', line)
+        if not match:
+            continue
+        idx = int(match.group(1)) - 1
+        if not 0 <= idx < len(values):
+            continue
+        rest = match.group(2).strip()
+        date = re.match(r'\d{2}\.\d{2}', rest)
+        if date:
+            results[values[idx]] = date.group(0)
+        elif not rest:
+            results[values[idx]] = ''
+    return results
 
-def insert_signature_images(ws, signature_col, image_dir):
+def resolve_column_mapping(cache, headers1, headers2, mapping_type, is_comparing_1_and_3=False, consensus=False):
     """
-    将签名列中的文本替换为对应的图片
+    获取表1与另一个表之间的列映射关系（另一个表的列索引 -> 表1的列索引）
     
-    参数：
-        ws：openpyxl工作表对象
-        signature_col：签名列索引（1-based，负数表示从末尾开始计数）
-        image_dir：图片目录路径
+    依次尝试：缓存、本地规则匹配、历史表头相似度索引；仍无法确定的列才交给AI，且只发送这些列。
+    consensus为True时并行发送多个请求，达到法定票数后采用（见acompare_headers_consensus）。
+    """
+    with span('map', mapping_type=mapping_type):
+        mapping, unresolved1, unresolved2, needs_ai = prepare_column_mapping(cache, headers1, headers2, mapping_type)
+        if not needs_ai:
+            return mapping
+        if consensus:
+            ai_mapping, agreement = asyncio.run(acompare_headers_consensus(
+                headers1, headers2, is_comparing_1_and_3=is_comparing_1_and_3,
+                indices1=unresolved1, indices2=unresolved2))
+            cacheable = agreement >= CONSENSUS_MIN_AGREEMENT
+        else:
+            ai_response = compare_headers_with_ai(headers1, headers2, is_comparing_2_and_3=False,
+                                                  is_comparing_1_and_3=is_comparing_1_and_3,
+                                                  indices1=unresolved1, indices2=unresolved2)
+            # 空回答表示剩余列之间没有对应关系，只有调用失败（None）时不保存到缓存
+            ai_mapping, cacheable = parse_ai_response(ai_response) if ai_response is not None else None, True
+        return finish_column_mapping(cache, headers1, headers2, mapping_type, mapping,
+                                     unresolved1, unresolved2, ai_mapping, cacheable)
+
+async def resolve_column_mapping_async(cache, headers1, headers2, mapping_type, is_comparing_1_and_3=False,
+                                       consensus=False):
+    """resolve_column_mapping的异步版本"""
+    with span('map', mapping_type=mapping_type):
+        mapping, unresolved1, unresolved2, needs_ai = prepare_column_mapping(cache, headers1, headers2, mapping_type)
+        if not needs_ai:
+            return mapping
+        if consensus:
+            ai_mapping, agreement = await acompare_headers_consensus(
+                headers1, headers2, is_comparing_1_and_3=is_comparing_1_and_3,
+                indices1=unresolved1, indices2=unresolved2)
+            cacheable = agreement >= CONSENSUS_MIN_AGREEMENT
+        else:
+            ai_response = await acompare_headers_with_ai(headers1, headers2, is_comparing_2_and_3=False,
+                                                         is_comparing_1_and_3=is_comparing_1_and_3,
+                                                         indices1=unresolved1, indices2=unresolved2)
+            # 空回答表示剩余列之间没有对应关系，只有调用失败（None）时不保存到缓存
+            ai_mapping, cacheable = parse_ai_response(ai_response) if ai_response is not None else None, True
+        return finish_column_mapping(cache, headers1, headers2, mapping_type, mapping,
+                                     unresolved1, unresolved2, ai_mapping, cacheable)
+
+def prepare_column_mapping(cache, headers1, headers2, mapping_type):
+    """
+    在不调用AI的情况下尽量确定列映射关系
+    
+    返回：
+        (mapping, unresolved1, unresolved2, needs_ai)。needs_ai为False时mapping即为最终结果
+        （非空时已保存到缓存）
+    """
+    # 尝试从缓存中获取映射关系
+    mapping = cache.get_mapping(headers1, headers2, mapping_type)
+    if mapping is not None:
+        print("使用缓存中的映射关系")
+        current_span().set(cache='hit')
+        return mapping, [], [], False
+    
+    print("没有找到缓存中的映射关系，先在本地匹配表头...")
+    mapping, unresolved1, unresolved2, _ = match_headers(headers1, headers2)
+    print(f"本地匹配了{len(mapping)}列")
+    current_span().set(cache='miss', local_matched=len(mapping))
+    
+    # 用历史上确认过的表头对推断剩余的列
+    if unresolved1 and unresolved2:
+        inferred, report = HeaderSimilarityIndex.from_cache(cache).infer_mapping(
+            headers1, headers2, unresolved1, unresolved2)
+        for header2, known_header, header1, score in report:
+            print(f"根据历史映射推断：{header2} -> {header1}（相似表头：{known_header}，相似度{score:.2f}）")
+        mapping.update(inferred)
+        current_span().set(inferred=len(inferred))
+        unresolved1 = [i for i in unresolved1 if i not in inferred.values()]
+        unresolved2 = [j for j in unresolved2 if j not in inferred]
+    
+    ai_columns = columns_for_ai(headers1, unresolved1, unresolved2)
+    if ai_columns is not None:
+        unresolved1, unresolved2 = ai_columns
+        print(f"剩余{len(unresolved1)}列和{len(unresolved2)}列使用AI分析：{[headers2[j] for j in unresolved2]}")
+        current_span().set(ai_columns=len(unresolved2))
+        return mapping, unresolved1, unresolved2, True
+    
+    if mapping:
+        # 保存映射关系到缓存；本地规则和历史推断的结果不算作确认过的表头对，不加入相似度索引
+        cache.save_mapping(headers1, headers2, mapping_type, mapping, confirmed=())
+    return mapping, unresolved1, unresolved2, False
+
+def finish_column_mapping(cache, headers1, headers2, mapping_type, mapping, unresolved1, unresolved2,
+                          ai_mapping, cacheable=True):
+    """
+    加入AI对剩余列给出的对应关系
+    
+    ai_mapping为None表示AI调用失败；只有AI调用成功且cacheable为True（如共识达到阈值）时才保存到缓存
     """
+    if ai_mapping is not None:
+        # 只接受未匹配列之间的对应关系
+        confirmed = []
+        for idx2, idx1 in ai_mapping.items():
+            if idx2 in unresolved2 and idx1 in unresolved1 and idx1 not in mapping.values():
+                mapping[idx2] = idx1
+                confirmed.append(idx2)
+        if mapping and cacheable:
+            # 保存映射关系到缓存，只有AI确认的表头对加入相似度索引
+            cache.save_mapping(headers1, headers2, mapping_type, mapping, confirmed=confirmed)
+        elif mapping:
+            print("AI结果的一致性未达到阈值，映射关系不保存到缓存")
+    return mapping
+
+def normalize_student_ids(ids):
+    """统一学号格式：去除首尾空白和astype(str)遗留的“.0”后缀，空值保留为缺失值"""
+    ids = ids.astype('string').str.strip()
+    ids = ids.str.replace(r'\.0+$', '', regex=True)
+    return ids.mask(ids.isin(['', 'nan', 'None', 'NaT', '<NA>']))
+
+# 签名图片所在单元格的大小（以像素为单位）
+SIGNATURE_CELL_HEIGHT = 20  # Excel默认行高（约20像素）
+SIGNATURE_CELL_WIDTH = 64   # Excel默认列宽（约64像素）
+
+# 输出表格的共享样式：所有单元格细边框、居中；表头加粗；学号列为文本格式
+THIN_SIDE = Side(style='thin')
+CELL_BORDER = Border(left=THIN_SIDE, right=THIN_SIDE, top=THIN_SIDE, bottom=THIN_SIDE)
+CELL_ALIGNMENT = Alignment(horizontal='center', vertical='center')
+
+def _create_output_styles(wb):
+    """在工作簿中注册输出表格使用的命名样式，所有单元格共用"""
+    styles = {
+        'merged_header': NamedStyle(name='merged_header', font=Font(bold=True)),
+        'merged_header_text': NamedStyle(name='merged_header_text', font=Font(bold=True), number_format='@'),
+        'merged_cell': NamedStyle(name='merged_cell'),
+        'merged_text': NamedStyle(name='merged_text', number_format='@'),
+    }
+    for style in styles.values():
+        style.border = CELL_BORDER
+        style.alignment = CELL_ALIGNMENT
+        wb.add_named_style(style)
+    return styles
+
+def create_signature_image(image_path):
+    """创建缩放到单元格大小的签名图片对象"""
     from openpyxl.drawing.image import Image
-    import os
     
-    # 获取数据范围
-    data_rows = ws.max_row
-    data_cols = ws.max_column
+    img = Image(image_path)
+    
+    # 计算缩放比例以适应单元格大小
+    width_ratio = SIGNATURE_CELL_WIDTH / img.width
+    height_ratio = SIGNATURE_CELL_HEIGHT / img.height
+    scale_ratio = min(width_ratio, height_ratio)
+    
+    # 缩放图片以适应单元格
+    img.width = int(img.width * scale_ratio)
+    img.height = int(img.height * scale_ratio)
+    return img
+
+def resolve_signature_images(signatures, image_dir):
+    """
+    为签名列的每一行查找签名图片，并生成缩小到单元格大小的缩略图
+    
+    返回：
+        与signatures等长的列表，每项为要嵌入的图片路径（优先使用缩略图），没有图片时为None
+    """
+    # 建立图片目录的索引（只重新扫描有变化的目录）
+    signature_index = SignatureIndex(image_dir)
     
+    # 相同的签名值只查找一次（提示也只输出一次）
+    resolved = {}
+    matches = []
+    for value in signatures:
+        if _cell_value(value) is None:
+            matches.append(None)
+            continue
+        cell_value = str(value).strip()
+        if cell_value not in resolved:
+            # 有多张匹配的图片时使用最新的
+            matching_images = signature_index.find_all(cell_value)
+            if len(matching_images) > 1:
+                print(f"签名{cell_value}匹配到{len(matching_images)}张图片，使用最新的：{os.path.basename(matching_images[0])}")
+            elif not matching_images:
+                print(f"没有找到匹配的图片：{cell_value}")
+            resolved[cell_value] = matching_images[0] if matching_images else None
+        matches.append(resolved[cell_value])
+    
+    # 嵌入缩略图而不是原图，缩略图生成失败时退回原图
+    thumbnails = make_thumbnails([m for m in matches if m], (SIGNATURE_CELL_WIDTH, SIGNATURE_CELL_HEIGHT))
+    return [thumbnails.get(m, m) if m else None for m in matches]
+
+def _cell_value(value):
+    """将DataFrame中的值转换为可写入Excel的值，缺失值写为空单元格"""
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return value
+
+def write_formatted_excel(output_path, title_row, df, image_dir=None):
+    """
+    一次写出带格式的结果文件
+    
+    使用只写模式逐行写入，写入时直接应用合并的标题行、边框、居中对齐、
+    学号列文本格式，并将签名列中的文本替换为对应的图片，无需保存后再重新打开格式化。
+    
+    参数：
+        output_path：输出文件路径
+        title_row：表1的标题行（写入第一行并合并单元格）
+        df：需要写入的数据（表头写入第二行）
+        image_dir：签名图片目录，为None或不存在时不插入图片
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    _create_output_styles(wb)
+    
+    data_cols = len(df.columns)
+    student_id_col = SPECIAL_COLUMNS['student_id']
+    signature_col = SPECIAL_COLUMNS['signature']
     # 处理负数列索引
     if signature_col < 0:
         signature_col = data_cols + signature_col + 1
     
-    # 获取图片目录中的所有文件
-    image_files = os.listdir(image_dir)
-    
-    # 获取默认单元格大小（以像素为单位）
-    default_row_height = 20  # Excel默认行高（约20像素）
-    default_col_width = 64   # Excel默认列宽（约64像素）
-    
-    # 遍历签名列中的每个单元格
-    for row in range(2, data_rows + 1):  # 从第二行开始（跳过标题行）
-        cell = ws.cell(row=row, column=signature_col)
-        if cell.value:
-            # 构造完整的图片文件名模式（包括时间戳）
-            cell_value = str(cell.value).strip()
-            
-            # 在图片目录中查找匹配的图片文件
-            matching_image = None
-            for image_file in image_files:
-                # 检查文件名是否包含单元格值（考虑时间戳等）
-                if cell_value in image_file and any(image_file.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg']):
-                    matching_image = image_file
-                    break
-            
-            if matching_image:
-                try:
-                    # 创建图片对象
-                    image_path = os.path.join(image_dir, matching_image)
-                    img = Image(image_path)
-                    
-                    # 计算缩放比例以适应单元格大小
-                    width_ratio = default_col_width / img.width
-                    height_ratio = default_row_height / img.height
-                    scale_ratio = min(width_ratio, height_ratio)
-                    
-                    # 缩放图片以适应单元格
-                    img.width = int(img.width * scale_ratio)
-                    img.height = int(img.height * scale_ratio)
-                    
-                    # 将图片添加到单元格
-                    img.anchor = f"{get_column_letter(signature_col)}{row}"
-                    ws.add_image(img)
-                    
-                    # 清除单元格文本内容
-                    cell.value = None
-                    
-                except Exception as e:
-                    print(f"处理图片{matching_image}出错：{str(e)}")
-            else:
-                print(f"没有找到匹配的图片：{cell_value}")
-
-def apply_excel_formatting(output_path):
-    # 打开工作簿
-    wb = openpyxl.load_workbook(output_path)
-    ws = wb.active
-    
-    # 定义边框样式（正常边框）
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # 获取数据范围
-    data_rows = ws.max_row
-    data_cols = ws.max_column
-    
-    # 合并第一行单元格（从A1到最后一列）
-    ws.merge_cells(f'A1:{get_column_letter(data_cols)}1')
-    ws.cell(row=1, column=1).alignment = Alignment(horizontal='center', vertical='center')
-    
-    # 遍历所有单元格
-    for row in range(1, data_rows + 1):
-        for col in range(1, data_cols + 1):
-            cell = ws.cell(row=row, column=col)
-            
-            # 添加边框和居中对齐到所有单元格
-            cell.border = border
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            # 如果是学号列，设置为文本格式
-            if row > 1 and col == SPECIAL_COLUMNS['student_id']:  
-                cell.number_format = '@'
-    
-    # 设置第一行高度
+    # 行高和合并单元格必须在写入行之前设置
     ws.row_dimensions[1].height = 30  # 设置为30单位
+    ws.merged_cells.add(f'A1:{get_column_letter(data_cols)}1')
     
-    # 处理签名图片（假设签名在最后一列）
-    image_dir = "***"
-    if os.path.exists(image_dir):
-        insert_signature_images(ws, SPECIAL_COLUMNS['signature'], image_dir)
+    # 写入前先为所有签名找到图片
+    signature_images = None
+    if image_dir and os.path.exists(image_dir) and 0 < signature_col <= data_cols:
+        with span('images', rows=len(df)) as images_span:
+            signature_images = resolve_signature_images(df.iloc[:, signature_col - 1].tolist(), image_dir)
+            images_span.set(found=sum(1 for image in signature_images if image))
     
-    # 保存更改
-    wb.save(output_path)
-
-def merge_excel_files():
-    start_time = time.time()
-    print("正在合并Excel文件...")
-    # 初始化缓存系统
-    cache = MappingCache()
-    
-    # 读取三个Excel文件
-    file1_path = "***"
-    file2_path = "***"
-    file3_path = "***"
-    
-    # 读取表1（包括第一行）、表2和表3
-    df1_full = pd.read_excel(file1_path)  # 读取完整的表1，包括第一行
-    df1 = pd.read_excel(file1_path, header=1)  # 读取表1的数据部分
-    df2 = pd.read_excel(file2_path, dtype={'请输入你的学号（必填）': str})  # 读取表2，学号列作为字符串
-    df3 = pd.read_excel(file3_path, header=1)  # 读取表3，跳过第一行
-    
-    # 获取标题
-    headers1 = df1.columns.tolist()
-    headers2 = df2.columns.tolist()
-    headers3 = df3.columns.tolist()
-    
-    # 尝试从缓存中获取表1和表2之间的映射关系
-    index_mapping = cache.get_mapping(headers1, headers2, "1_to_2")
-    if index_mapping is None:
-        print("没有找到缓存中的映射关系，使用AI分析...")
-        # 使用AI获取表1和表2之间的列映射关系
-        ai_response = compare_headers_with_ai(headers1, headers2)
-        index_mapping = parse_ai_response(ai_response)
-        if index_mapping:
-            # 保存映射关系到缓存
-            cache.save_mapping(headers1, headers2, "1_to_2", index_mapping)
-    else:
-        print("使用缓存中的映射关系")
+    def make_cell(value, style):
+        cell = WriteOnlyCell(ws, value=_cell_value(value))
+        cell.style = style
+        return cell
     
-    if not index_mapping:
-        print("获取列映射关系失败，程序终止")
-        return
-
-    # 尝试从缓存中获取表1和表3之间的映射关系
-    table3_mapping = cache.get_mapping(headers1, headers3, "1_to_3")
-    if table3_mapping is None:
-        print("没有找到缓存中的映射关系，使用AI分析...")
-        # 使用AI获取表1和表3之间的列映射关系
-        ai_response3 = compare_headers_with_ai(headers1, headers3, is_comparing_2_and_3=False, is_comparing_1_and_3=True)
-        if ai_response3:
-            table3_mapping = {}
-            for line in ai_response3.strip().split('\n'):
-                if '对应' in line:
-                    parts = line.replace('。', '').split('对应')
-                    table1_part = parts[0].strip()
-                    table3_part = parts[1].strip()
-                    
-                    # 提取索引（转换为0-based索引）
-                    idx1 = int(table1_part.split('的')[1]) - 1
-                    idx3 = int(table3_part.split('的')[1]) - 1
-                    
-                    # 创建映射关系（从表3到表1）
-                    table3_mapping[idx3] = idx1
-            
-            if table3_mapping:
-                # 保存映射关系到缓存
-                cache.save_mapping(headers1, headers3, "1_to_3", table3_mapping)
-    else:
-        print("使用缓存中的映射关系")
+    # 第一行：标题行
+    title_values = list(title_row or [])[:data_cols]
+    title_values += [None] * (data_cols - len(title_values))
+    ws.append([make_cell(value, 'merged_header') for value in title_values])
     
-    if not table3_mapping:
-        print("获取列映射关系失败，程序终止")
-        return
+    # 第二行：表头
+    ws.append([make_cell(value, 'merged_header_text' if col == student_id_col else 'merged_header')
+               for col, value in enumerate(df.columns, 1)])
+    
+    # 数据行
+    for row, values in enumerate(df.itertuples(index=False, name=None), 3):
+        cells = []
+        for col, value in enumerate(values, 1):
+            if col == signature_col and signature_images is not None and signature_images[row - 3]:
+                # 将签名文本替换为对应的图片
+                image_path = signature_images[row - 3]
+                try:
+                    img = create_signature_image(image_path)
+                    img.anchor = f"{get_column_letter(col)}{row}"
+                    ws.add_image(img)
+                    value = None
+                except Exception as e:
+                    print(f"处理图片{image_path}出错：{str(e)}")
+            cells.append(make_cell(value, 'merged_text' if col == student_id_col else 'merged_cell'))
+        ws.append(cells)
+    
+    wb.save(output_path)
 
+def build_merged_frame(headers1, df2, headers2, index_mapping):
+    """按表1的结构和表1与表2的映射关系构建结果DataFrame"""
     # 创建一个新的DataFrame，完全复制表1的结构
     new_df = pd.DataFrame(columns=headers1)
     
@@ -295,77 +498,47 @@ def merge_excel_files():
     
     # 处理学号列
     if '学号' in new_df.columns:
-        new_df['学号'] = new_df['学号'].astype(str)
-    
-    # 处理日期格式
-    if '离校时间' in new_df.columns:
-        new_df['离校时间'] = format_date_with_ai(new_df['离校时间'].tolist())
-    if '返校时间' in new_df.columns:
-        new_df['返校时间'] = format_date_with_ai(new_df['返校时间'].tolist())
-    
-    # 合并表3的数据
-    print("\n合并表3的数据...")
-    print("表1和表3的对应关系：")
-    for idx3, idx1 in table3_mapping.items():
-        print(f"表3的第{idx3+1}列 -> 表1的第{idx1+1}列")
+        new_df['学号'] = normalize_student_ids(new_df['学号']).fillna('')
+    return new_df
+
+def merge_excel_files(file1_path="***", file2_path="***", file3_path="***", image_dir="***", output_dir=None,
+                      use_async=True, consensus=False, cache=None, value_cache=None, incremental=False):
+    """
+    合并三个Excel文件并写出带格式的结果文件（merge_engine.run_merge_job的固定三表配置）
     
-    # 确保学号列存在于new_df中
-    if '学号' in new_df.columns:
-        # 获取表3的学号列（根据映射关系）
-        student_id_col = None
-        for idx3, idx1 in table3_mapping.items():
-            if headers1[idx1] == '学号':
-                student_id_col = idx3
-                break
+    参数：
+        file1_path：表1（模板，第一行为标题行）
+        file2_path：表2（问卷数据，结果的每一行来自表2）
+        file3_path：表3（教务数据，第一行为标题行，按学号覆盖对应列）
+        image_dir：签名图片目录
+        output_dir：输出目录，默认与表1相同
+        use_async：是否同时读取表2和表3并并发进行AI调用
+        consensus：是否使用共识模式获取映射关系
+        cache/value_cache：映射缓存和值缓存，默认使用当前目录下的缓存文件
+        incremental：是否增量合并（只处理上次合并后新增或修改的行，见incremental_merge），
+            仍然写出完整的结果文件
         
-        if student_id_col is not None:
-            df3['学号'] = df3.iloc[:, student_id_col].astype(str)
-            
-            # 遍历表3的每一行
-            for idx3, row3 in df3.iterrows():
-                # 在new_df中查找匹配的学号
-                mask = new_df['学号'] == row3['学号']
-                if mask.any():
-                    # 找到匹配的行，更新对应的列
-                    for col3, col1 in table3_mapping.items():
-                        new_df.loc[mask, headers1[col1]] = row3.iloc[col3]
-    
-    # 按学号排序
-    if '学号' in new_df.columns:
-        new_df = new_df.sort_values('学号')
-        # 重新生成序号
-        if '序号' in new_df.columns:
-            new_df['序号'] = range(1, len(new_df) + 1)
-    
-    # 生成新的文件名（包括时间戳）
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_filename = f'Merged_result_{timestamp}.xlsx'
-    output_path = os.path.join(os.path.dirname(file1_path), output_filename)
-    
-    # 获取第一行数据
-    first_row = pd.read_excel(file1_path, nrows=1)
-    
-    # 使用ExcelWriter保存，允许多个DataFrame
-    with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-        # 首先写入第一行
-        first_row.to_excel(writer, index=False)
-        # 写入数据，从第二行开始
-        new_df.to_excel(writer, index=False, startrow=1)
-    
-    # 应用格式化
-    apply_excel_formatting(output_path)
-    
-    print(f"\n生成的合并文件：{output_filename}")
-    print(f"包含{len(new_df)}条记录")
-    print("应用了格式化：")
-    print("- 保留了原始表的第一行和合并单元格")
-    print("- 居中对齐了所有单元格")
-    print("- 合并了表2和表3的数据")
-    print("- 添加了细边框到所有单元格")
-    print("- 将学号列设置为文本格式以避免科学计数法")
-    print("- 统一了日期格式为mm.dd")
-    print(f"\nExcel合并完成！总耗时：{time.time() - start_time:.2f}秒")
-    return output_path
+    返回：
+        输出文件路径，获取映射关系失败时返回None
+    """
+    from merge_engine import run_merge_job
+    from incremental_merge import run_incremental_merge
+    
+    job = {
+        'template': {'path': file1_path, 'header_row': 1},
+        'key': '学号',
+        'sources': [
+            {'name': '表2', 'path': file2_path, 'header_row': 0, 'key': '请输入你的学号（必填）',
+             'mapping_type': '1_to_2'},
+            {'name': '表3', 'path': file3_path, 'header_row': 1, 'mapping_type': '1_to_3'},
+        ],
+        'image_dir': image_dir,
+        'output_dir': output_dir,
+    }
+    if incremental:
+        return run_incremental_merge(job, use_async=use_async, consensus=consensus, cache=cache,
+                                     value_cache=value_cache, full_output=True)
+    return run_merge_job(job, use_async=use_async, consensus=consensus, cache=cache, value_cache=value_cache)
 
 if __name__ == "__main__":
     merge_excel_files()
@@ -0,0 +1,300 @@
+"""
+离线的OpenAI兼容对话接口，用于在没有网络的环境下测试和压测
+
+支持 /v1/chat/completions 的流式和非流式请求：
+- 表头比较请求：用本地规则匹配（header_matcher）生成“表X的第i列 对应 表Y的第j列”
+- 日期格式化请求：用本地日期解析（date_normalizer）生成“编号. mm.dd”
+- 其他请求：返回固定内容
+
+可配置延迟分布、错误率、限流（429）和回答的不确定性（打乱行顺序、随机漏掉对应关系）。
+使用方法：
+    python mock_server.py --port 8000 --latency lognormal --latency-mean 0.8 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 python merge_excel.py
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from header_matcher import match_headers
+from date_normalizer import parse_dates_locally
+
+# 表头比较的本地匹配阈值（略低于header_matcher的默认值，模拟AI更宽松的判断）
+MAPPING_THRESHOLD = 0.6
+
+# 提示词中的表头/日期列表行，如“3. 学号”
+NUMBERED_LINE = re.compile(r'^\s*(\d+)\.\s?(.*)$')
+HEADER_SECTION = re.compile(r'这是表(\d+)的表头：\n(.*?)(?:\n\n|$)', re.S)
+DATE_SECTION = re.compile(r'需要转换的日期：\n(.*?)(?:\n\n|$)', re.S)
+
+class MockConfig:
+    """模拟接口的行为配置"""
+
+    def __init__(self, latency='constant', latency_mean=0.5, latency_sigma=0.5, latency_max=30.0,
+                 error_rate=0.0, error_status=500, rate_limit=0, shuffle_rate=0.0, drop_rate=0.0,
+                 stream_chunk=8, seed=None):
+        """
+        参数：
+            latency：延迟分布，constant/uniform/exponential/lognormal
+            latency_mean：平均延迟（秒）
+            latency_sigma：lognormal分布的形状参数（越大长尾越明显）
+            latency_max：单次延迟上限（秒）
+            error_rate：返回服务端错误的概率
+            error_status：注入错误使用的HTTP状态码
+            rate_limit：每分钟最多处理的请求数，超出时返回429，0表示不限制
+            shuffle_rate：打乱回答行顺序的概率
+            drop_rate：每条对应关系被漏掉的概率（模拟不稳定的回答）
+            stream_chunk：流式响应每个分块的字符数
+            seed：随机种子，便于复现
+        """
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.latency_max = latency_max
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit = rate_limit
+        self.shuffle_rate = shuffle_rate
+        self.drop_rate = drop_rate
+        self.stream_chunk = stream_chunk
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = []
+        self.counts = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+
+    def sample_latency(self):
+        """按配置的分布抽取一次延迟"""
+        mean = self.latency_mean
+        with self.lock:
+            if self.latency == 'uniform':
+                value = self.random.uniform(0, 2 * mean)
+            elif self.latency == 'exponential':
+                value = self.random.expovariate(1 / mean) if mean > 0 else 0.0
+            elif self.latency == 'lognormal':
+                # 使分布的均值等于latency_mean
+                mu = math.log(mean) - self.latency_sigma ** 2 / 2 if mean > 0 else 0.0
+                value = self.random.lognormvariate(mu, self.latency_sigma) if mean > 0 else 0.0
+            else:
+                value = mean
+        return min(value, self.latency_max)
+
+    def chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def admit(self):
+        """限流检查：最近60秒内的请求数未超过rate_limit时放行，否则返回建议的重试秒数"""
+        with self.lock:
+            self.counts['requests'] += 1
+            if not self.rate_limit:
+                return 0
+            now = time.monotonic()
+            self.window = [t for t in self.window if now - t < 60]
+            if len(self.window) >= self.rate_limit:
+                self.counts['rate_limited'] += 1
+                return max(1, math.ceil(60 - (now - self.window[0])))
+            self.window.append(now)
+            return 0
+
+def _numbered_lines(text):
+    """解析“编号. 内容”列表，返回[(编号, 内容)]"""
+    items = []
+    for line in text.split('\n'):
+        match = NUMBERED_LINE.match(line)
+        if match:
+            items.append((int(match.group(1)), match.group(2).strip()))
+    return items
+
+def answer_mapping(prompt, config):
+    """用本地规则匹配回答表头比较请求"""
+    sections = HEADER_SECTION.findall(prompt)
+    if len(sections) < 2:
+        return ''
+    (table1, text1), (table2, text2) = sections[:2]
+    items1, items2 = _numbered_lines(text1), _numbered_lines(text2)
+    mapping, _, _, _ = match_headers([h for _, h in items1], [h for _, h in items2],
+                                     threshold=MAPPING_THRESHOLD)
+    lines = [f"表{table1}的第{items1[i][0]}列 对应 表{table2}的第{items2[j][0]}列"
+             for j, i in sorted(mapping.items(), key=lambda item: item[1])
+             if not config.chance(config.drop_rate)]
+    if config.chance(config.shuffle_rate):
+        with config.lock:
+            config.random.shuffle(lines)
+    return '\n'.join(lines)
+
+def answer_dates(prompt, config):
+    """用本地日期解析回答日期格式化请求，无法解析的编号后留空"""
+    match = DATE_SECTION.search(prompt)
+    if not match:
+        return ''
+    items = _numbered_lines(match.group(1))
+    parsed = parse_dates_locally([value for _, value in items])
+    lines = [f"{number}. {value or ''}".rstrip() for (number, _), value in zip(items, parsed)]
+    if config.chance(config.shuffle_rate):
+        with config.lock:
+            config.random.shuffle(lines)
+    return '\n'.join(lines)
+
+def build_answer(messages, config):
+    """根据提示词类型生成回答"""
+    prompt = str(messages[-1].get('content', '')) if messages else ''
+    if '需要转换的日期' in prompt:
+        return answer_dates(prompt, config)
+    if '的表头' in prompt:
+        return answer_mapping(prompt, config)
+    return 'OK'
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, message, error_type, headers=None):
+        self._send_json(status, {'error': {'message': message, 'type': error_type, 'code': status}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}]})
+        else:
+            self._send_error(404, 'not found', 'invalid_request_error')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_error(400, 'invalid JSON body', 'invalid_request_error')
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_error(404, 'not found', 'invalid_request_error')
+            return
+
+        config = self.config
+        retry_after = config.admit()
+        if retry_after:
+            self._send_error(429, 'rate limit exceeded', 'rate_limit_error', {'Retry-After': str(retry_after)})
+            return
+
+        latency = config.sample_latency()
+        if config.chance(config.error_rate):
+            with config.lock:
+                config.counts['errors'] += 1
+            time.sleep(latency)
+            self._send_error(config.error_status, 'injected server error', 'server_error')
+            return
+
+        messages = request.get('messages') or []
+        model = request.get('model') or 'mock'
+        content = build_answer(messages, config)
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in messages)
+        completion_tokens = len(content)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        if not request.get('stream'):
+            time.sleep(latency)
+            self._send_json(200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens},
+            })
+            return
+
+        # 流式响应：首个分块前等待约一半延迟，其余延迟平均分配到各分块之间
+        chunks = [content[i:i + config.stream_chunk] for i in range(0, len(content), config.stream_chunk)] or ['']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(latency / 2)
+        for i, text in enumerate(chunks):
+            self._write_event({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                               'model': model,
+                               'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': text} if i == 0
+                                            else {'content': text}, 'finish_reason': None}]})
+            time.sleep(latency / 2 / len(chunks))
+        self._write_event({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                           'model': model, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _write_event(self, payload):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+class MockServer(ThreadingHTTPServer):
+    """监听队列足够长，压测时大量并发连接不会被拒绝"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+def start_server(config=None, host='127.0.0.1', port=0):
+    """
+    在后台线程中启动模拟接口
+
+    返回：
+        (server, base_url)。base_url可直接作为OPENAI_BASE_URL使用，结束时调用server.shutdown()
+    """
+    handler = type('ConfiguredMockHandler', (MockHandler,), {'config': config or MockConfig()})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description='离线的OpenAI兼容对话接口（用于测试和压测）')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', choices=['constant', 'uniform', 'exponential', 'lognormal'],
+                        default='constant', help='延迟分布')
+    parser.add_argument('--latency-mean', type=float, default=0.5, help='平均延迟（秒）')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='lognormal分布的形状参数')
+    parser.add_argument('--latency-max', type=float, default=30.0, help='单次延迟上限（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回服务端错误的概率')
+    parser.add_argument('--error-status', type=int, default=500, help='注入错误的HTTP状态码')
+    parser.add_argument('--rate-limit', type=int, default=0, help='每分钟最多请求数，超出返回429')
+    parser.add_argument('--shuffle-rate', type=float, default=0.0, help='打乱回答行顺序的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='每条对应关系被漏掉的概率')
+    parser.add_argument('--seed', type=int, default=None, help='随机种子')
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, latency_mean=args.latency_mean, latency_sigma=args.latency_sigma,
+                        latency_max=args.latency_max, error_rate=args.error_rate, error_status=args.error_status,
+                        rate_limit=args.rate_limit, shuffle_rate=args.shuffle_rate, drop_rate=args.drop_rate,
+                        seed=args.seed)
+    handler = type('ConfiguredMockHandler', (MockHandler,), {'config': config})
+    server = MockServer((args.host, args.port), handler)
+    print(f"模拟接口已启动：http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"请求统计：{config.counts}")
+
+if __name__ == "__main__":
+    main()
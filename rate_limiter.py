@@ -0,0 +1,176 @@
+import asyncio
+import os
+import threading
+import time
+
+# 并发上限（AIMD调整）的初始值和范围
+INITIAL_CONCURRENCY = int(os.getenv("AI_INITIAL_CONCURRENCY", "4"))
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "32"))
+
+# 每分钟请求数和token数预算，0表示不限制
+REQUESTS_PER_MINUTE = int(os.getenv("AI_REQUESTS_PER_MINUTE", "0"))
+TOKENS_PER_MINUTE = int(os.getenv("AI_TOKENS_PER_MINUTE", "0"))
+
+# 延迟超过平均延迟的该倍数时视为过载
+LATENCY_TOLERANCE = 2.0
+
+# 连续失败该次数后熔断，熔断持续的秒数
+FAILURE_THRESHOLD = int(os.getenv("AI_BREAKER_FAILURES", "5"))
+RESET_TIMEOUT = float(os.getenv("AI_BREAKER_RESET", "30"))
+
+# 等待并发名额时的轮询间隔（秒）
+POLL_INTERVAL = 0.05
+
+class CircuitOpenError(Exception):
+    """熔断期间直接拒绝请求"""
+
+class TokenBucket:
+    """按每分钟预算匀速补充的令牌桶"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """取得amount个令牌还需等待的秒数（超过容量的请求按容量计算）"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """扣除令牌，允许为负（实际用量超过预估时）"""
+        self.tokens -= amount
+
+class ConcurrencyController:
+    """
+    所有AI调用共用的客户端限流器
+
+    - 并发上限按AIMD调整：请求成功且延迟正常时缓慢增加，出错或延迟明显变长时减半
+    - 按每分钟请求数和token数预算限速
+    - 连续失败达到阈值后熔断，熔断期间直接失败；超时后放行一个试探请求
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, min_limit=MIN_CONCURRENCY, max_limit=MAX_CONCURRENCY,
+                 requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.lock = threading.Lock()
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.avg_latency = None
+        self.last_decrease = 0.0
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def _try_acquire(self, tokens):
+        """尝试取得一个请求名额，成功返回0，否则返回建议等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            if self.opened_at is not None:
+                if now - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                    raise CircuitOpenError("AI接口暂时不可用（熔断中）")
+                # 熔断超时，放行一个试探请求
+                self.trial_in_flight = True
+
+            wait = 0.0
+            if self.in_flight >= int(self.limit):
+                wait = POLL_INTERVAL
+            if self.request_bucket is not None:
+                wait = max(wait, self.request_bucket.wait_time(1, now))
+            if self.token_bucket is not None:
+                wait = max(wait, self.token_bucket.wait_time(tokens, now))
+            if wait > 0:
+                if self.trial_in_flight and self.opened_at is not None:
+                    self.trial_in_flight = False
+                return wait
+
+            self.in_flight += 1
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(tokens)
+            return 0.0
+
+    def acquire(self, tokens=0):
+        """阻塞直到取得请求名额；熔断时抛出CircuitOpenError"""
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        """acquire的异步版本，等待时不阻塞事件循环"""
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, latency, ok, overloaded=False, extra_tokens=0, neutral=False):
+        """
+        归还请求名额并根据结果调整并发上限
+
+        参数：
+            latency：请求耗时（秒）
+            ok：请求是否成功
+            overloaded：失败是否由过载引起（连接错误、超时、限流、服务端错误）
+            extra_tokens：实际token用量超出预估的部分
+            neutral：没有得到接口的响应（如任务被取消、本地错误），只归还名额，
+                不调整并发上限和熔断状态（熔断试探请求的名额让给下一个请求）
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if self.token_bucket is not None and extra_tokens:
+                self.token_bucket.consume(extra_tokens)
+            if neutral:
+                if self.opened_at is not None:
+                    self.trial_in_flight = False
+                return
+
+            slow = self.avg_latency is not None and latency > self.avg_latency * LATENCY_TOLERANCE
+            if ok:
+                self.avg_latency = latency if self.avg_latency is None else 0.9 * self.avg_latency + 0.1 * latency
+            if not overloaded:
+                # 成功或接口返回的非过载错误（如请求参数错误）都说明接口可用，关闭熔断
+                self.consecutive_failures = 0
+                self.opened_at = None
+                self.trial_in_flight = False
+
+            if (overloaded or slow) and now - self.last_decrease > (self.avg_latency or 0):
+                # 乘性减少，每个平均往返时间内最多一次
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = now
+            elif ok and not slow:
+                # 加性增加，约每个往返周期加1
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            if overloaded:
+                self.consecutive_failures += 1
+                if self.trial_in_flight or self.consecutive_failures >= self.failure_threshold:
+                    self.opened_at = now
+                    self.trial_in_flight = False
+
+    def stats(self):
+        """返回当前并发上限、进行中的请求数和熔断状态"""
+        with self.lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "avg_latency": self.avg_latency,
+                "circuit_open": self.opened_at is not None,
+            }
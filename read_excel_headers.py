@@ -1,4 +1,4 @@
-import pandas as pd
+from workbook_loader import read_headers
 
 def read_excel_headers(file_path, header_row=0):
     """读取Excel文件的表头
@@ -11,10 +11,8 @@ def read_excel_headers(file_path, header_row=0):
         成功返回表头列表，失败返回None
     """
     try:
-        # 读取Excel文件，指定header行
-        df = pd.read_excel(file_path, header=header_row)
-        # 获取列名（表头）
-        return df.columns.tolist()
+        # 只解析到表头所在行，获取列名（表头）
+        return read_headers(file_path, header_row=header_row)
     except Exception as e:
         print(f"读取Excel文件出错：{str(e)}")
         return None
@@ -0,0 +1,165 @@
+import json
+import os
+import re
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves are not coordinated between processes
+    fcntl = None
+
+# 可作为签名图片的文件扩展名
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# 文件名切分规则：连续的非数字文字（如姓名）和连续的数字（如学号、时间戳）各为一个片段
+TOKEN_PATTERN = re.compile(r'[^\W\d_]+|\d+')
+
+class SignatureIndex:
+    def __init__(self, image_dir: str, index_file: str = 'signature_index.json'):
+        """
+        Initialize signature image index
+
+        Args:
+            image_dir: Directory containing signature images (searched recursively)
+            index_file: Path of the persistent index file, shared by all image directories
+        """
+        self.image_dir = os.path.abspath(image_dir)
+        self.index_file = index_file
+        self.entries = self._load_index()
+        self.changed = False
+        self._scan(self.image_dir)
+        if self.changed:
+            self._save_index()
+        self.index = self._build_index()
+
+    def _load_index(self) -> Dict:
+        """Load stored directory entries of this image directory"""
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    return json.load(f).get(self.image_dir, {})
+            return {}
+        except Exception as e:
+            print(f"Error loading signature index: {str(e)}")
+            return {}
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Hold an exclusive lock on the index file across processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.index_file}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save_index(self) -> None:
+        """
+        Save directory entries of this image directory, keeping other directories
+
+        Several processes (e.g. batch workers) may share one index file, so the
+        read-merge-write runs under a lock and writes through a per-process temp file.
+        """
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        try:
+            with self._locked():
+                data = {}
+                if os.path.exists(self.index_file):
+                    with open(self.index_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                data[self.image_dir] = self.entries
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            print(f"Error saving signature index: {str(e)}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _scan(self, directory: str) -> List[str]:
+        """
+        Refresh stored entries of a directory tree
+
+        Directories whose mtime is unchanged reuse their stored file list,
+        only changed directories are listed again. Returns the visited directories.
+        """
+        rel_dir = os.path.relpath(directory, self.image_dir)
+        mtime = os.stat(directory).st_mtime
+        entry = self.entries.get(rel_dir)
+        if entry is None or entry['mtime'] != mtime:
+            files, subdirs = [], []
+            with os.scandir(directory) as it:
+                for item in it:
+                    if item.is_dir():
+                        subdirs.append(item.name)
+                    elif item.name.lower().endswith(IMAGE_EXTENSIONS):
+                        files.append([item.name, item.stat().st_mtime])
+            entry = {'mtime': mtime, 'files': files, 'subdirs': subdirs}
+            self.entries[rel_dir] = entry
+            self.changed = True
+
+        visited = [rel_dir]
+        for subdir in entry['subdirs']:
+            subdir_path = os.path.join(directory, subdir)
+            if os.path.isdir(subdir_path):
+                visited.extend(self._scan(subdir_path))
+
+        # 删除已不存在的子目录记录
+        if rel_dir == '.':
+            for stale in set(self.entries) - set(visited):
+                del self.entries[stale]
+                self.changed = True
+        return visited
+
+    def _build_index(self) -> Dict[str, List[str]]:
+        """Map every file name token to its matching files, newest first"""
+        matches = {}
+        for rel_dir, entry in self.entries.items():
+            for name, mtime in entry['files']:
+                path = os.path.normpath(os.path.join(self.image_dir, rel_dir, name))
+                stem = os.path.splitext(name)[0]
+                for token in set(TOKEN_PATTERN.findall(stem)) | {stem}:
+                    matches.setdefault(token, []).append((mtime, path))
+        return {token: [path for _, path in sorted(files, reverse=True)]
+                for token, files in matches.items()}
+
+    def find_all(self, signer: str) -> List[str]:
+        """
+        Find all images whose file name contains the signer name or ID, newest first
+
+        Exact name/ID tokens are looked up in constant time; other values
+        fall back to a substring search over all file names.
+        """
+        signer = str(signer).strip()
+        if signer in self.index:
+            matches = self.index[signer]
+        else:
+            matches = [os.path.normpath(os.path.join(self.image_dir, rel_dir, name))
+                       for rel_dir, entry in self.entries.items()
+                       for name, _ in entry['files'] if signer in name]
+        return self._newest_first(matches) if len(matches) > 1 else matches
+
+    @staticmethod
+    def _newest_first(paths: List[str]) -> List[str]:
+        """
+        Order candidate files by their current mtime, dropping removed files
+
+        Overwriting a file in place leaves its directory mtime unchanged, so
+        the stored file mtimes may be stale; candidates are stat'ed again.
+        """
+        stamped = []
+        for path in paths:
+            try:
+                stamped.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        return [path for _, path in sorted(stamped, reverse=True)]
+
+    def find(self, signer: str) -> Optional[str]:
+        """Find the newest image matching the signer name or ID"""
+        matches = self.find_all(signer)
+        return matches[0] if matches else None
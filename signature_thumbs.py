@@ -0,0 +1,77 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# 缩略图按显示尺寸的倍数生成，在高分辨率屏幕上仍然清晰
+THUMBNAIL_SCALE = 2
+
+# 待生成的缩略图少于该数量时直接在当前进程处理，避免启动进程池的开销
+POOL_THRESHOLD = 8
+
+# 批量合并的工作进程中设置为1（见batch_merge._init_worker），此时始终在当前进程处理，不再嵌套创建进程池
+IN_PROCESS_ENV = 'AIEXCEL_LOAD_THREADS'
+
+def file_hash(path):
+    """计算文件内容的SHA-1（缩略图缓存和解析缓存共用）"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _make_thumbnail(image_path, size, cache_dir):
+    """
+    生成单个缩略图，缓存中已有时直接返回
+
+    缓存文件名由源文件内容的哈希和目标尺寸组成，源文件改变后自动生成新的缩略图。
+    """
+    from PIL import Image
+
+    width, height = size
+    thumb_path = os.path.join(cache_dir, f"{file_hash(image_path)}_{width}x{height}.png")
+    if os.path.exists(thumb_path):
+        return thumb_path
+
+    with Image.open(image_path) as img:
+        img = img.convert('RGBA')
+        img.thumbnail((width * THUMBNAIL_SCALE, height * THUMBNAIL_SCALE), Image.LANCZOS)
+        tmp_path = f"{thumb_path}.{os.getpid()}.tmp"
+        img.save(tmp_path, format='PNG', optimize=True)
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
+
+def make_thumbnails(image_paths, size, cache_dir='.signature_thumbnails', max_workers=None):
+    """
+    将签名图片缩小到单元格大小，多个图片在进程池中并行处理（设置了AIEXCEL_LOAD_THREADS=1时在当前进程处理）
+
+    参数：
+        image_paths：源图片路径列表
+        size：单元格显示尺寸（宽, 高），单位为像素
+        cache_dir：缩略图缓存目录
+        max_workers：最大进程数，默认为CPU核心数
+
+    返回：
+        源图片路径到缩略图路径的字典，处理失败的图片不在其中
+    """
+    image_paths = list(dict.fromkeys(image_paths))
+    if not image_paths:
+        return {}
+    os.makedirs(cache_dir, exist_ok=True)
+
+    thumbnails = {}
+    if len(image_paths) < POOL_THRESHOLD or os.getenv(IN_PROCESS_ENV) == '1':
+        for path in image_paths:
+            try:
+                thumbnails[path] = _make_thumbnail(path, size, cache_dir)
+            except Exception as e:
+                print(f"生成缩略图{path}出错：{str(e)}")
+        return thumbnails
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {path: executor.submit(_make_thumbnail, path, size, cache_dir) for path in image_paths}
+        for path, future in futures.items():
+            try:
+                thumbnails[path] = future.result()
+            except Exception as e:
+                print(f"生成缩略图{path}出错：{str(e)}")
+    return thumbnails
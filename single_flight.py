@@ -0,0 +1,247 @@
+import asyncio
+import glob
+import itertools
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:  # Windows：只合并同一进程内的请求
+    fcntl = None
+
+# 跨进程合并使用的目录（每个用户一个，只有本人可以访问）
+SHARED_DIR = os.path.join(tempfile.gettempdir(), f"aiexcel_single_flight_{getattr(os, 'getuid', lambda: 0)()}")
+
+# 进程异常退出时可能留下结果文件，超过该秒数的结果不再使用
+SHARED_RESULT_TTL = 60.0
+
+# 异步调用等待文件锁时的轮询间隔（秒）
+LOCK_POLL_INTERVAL = 0.05
+
+class SingleFlight:
+    """
+    相同请求的合并执行（single-flight）
+
+    同一进程内，相同键的并发调用只执行一次，其余调用等待并共享结果（或异常）。
+    启用cross_process时，不同进程中同时进行的相同调用也只执行一次：每个调用先登记等待标记，
+    再按键加文件锁排队；先拿到锁的进程执行调用，有其他进程在等待时写出结果供它们读取。
+    最后一个读取结果的进程删除结果和锁文件，目录中只保留正在进行的调用的文件。
+    """
+
+    def __init__(self, cross_process=False, shared_dir=SHARED_DIR, result_ttl=SHARED_RESULT_TTL):
+        self.cross_process = cross_process and fcntl is not None and self._prepare_shared_dir(shared_dir)
+        self.shared_dir = shared_dir
+        self.result_ttl = result_ttl
+        self.lock = threading.Lock()
+        self.calls = {}
+        # 事件循环 -> {键: 任务}；事件循环关闭并被回收后自动删除
+        self.async_calls = weakref.WeakKeyDictionary()
+        self.marker_ids = itertools.count()
+        self.coalesced = 0
+
+    @staticmethod
+    def _prepare_shared_dir(shared_dir):
+        """创建只有当前用户可以访问的共享目录，目录属于其他用户或是符号链接时不启用跨进程合并"""
+        try:
+            os.makedirs(shared_dir, mode=0o700, exist_ok=True)
+            info = os.lstat(shared_dir)
+            if stat.S_ISLNK(info.st_mode) or info.st_uid != os.getuid():
+                print(f"共享目录{shared_dir}不属于当前用户，只在进程内合并相同请求")
+                return False
+            if info.st_mode & 0o077:
+                os.chmod(shared_dir, 0o700)
+            return True
+        except OSError as e:
+            print(f"无法创建共享目录{shared_dir}：{str(e)}，只在进程内合并相同请求")
+            return False
+
+    def do(self, key, fn):
+        """执行fn()，同一时间相同key的调用共享一次执行的结果"""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(self._run_shared(key, fn))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result()
+
+    async def ado(self, key, coro_fn):
+        """do的异步版本，coro_fn()返回协程；等待方被取消不会取消正在执行的调用"""
+        loop = asyncio.get_running_loop()
+        calls = self.async_calls.setdefault(loop, {})
+        task = calls.get(key)
+        if task is None:
+            task = loop.create_task(self._arun_shared(key, coro_fn))
+            calls[key] = task
+
+            def done(_):
+                calls.pop(key, None)
+                if not calls:
+                    self.async_calls.pop(loop, None)
+            task.add_done_callback(done)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.shared_dir, f"{key}{suffix}")
+
+    def _register(self, key):
+        """登记等待标记（文件名包含进程号），返回标记文件路径"""
+        marker = self._path(key, f".{os.getpid()}.{next(self.marker_ids)}.wait")
+        os.close(os.open(marker, os.O_CREAT | os.O_WRONLY, 0o600))
+        return marker
+
+    def _other_waiters(self, key, marker):
+        """是否还有其他调用在等待该键的结果（忽略已退出进程留下的标记）"""
+        waiting = False
+        for path in glob.glob(glob.escape(self._path(key, '')) + '.*.wait'):
+            if path == marker:
+                continue
+            try:
+                os.kill(int(path.rsplit('.', 3)[1]), 0)
+            except ProcessLookupError:
+                self._remove(path)
+                continue
+            except (ValueError, OSError):
+                pass
+            waiting = True
+        return waiting
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _open_locked(self, key, flock):
+        """
+        打开并锁定键的锁文件；锁文件在等待期间被删除（已换成新文件）时重新打开
+
+        flock为加锁函数，非阻塞加锁失败时抛出BlockingIOError
+        """
+        lock_path = self._path(key, '.lock')
+        while True:
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                flock(fd)
+                if os.path.exists(lock_path) and os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                    return fd
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def _read_shared(self, key):
+        """读取其他进程写出的结果，不存在或已过期时返回None"""
+        try:
+            with open(self._path(key, '.json'), 'r', encoding='utf-8') as f:
+                shared = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - shared['time'] > self.result_ttl:
+            return None
+        self.coalesced += 1
+        return shared
+
+    def _write_shared(self, key, result):
+        result_path = self._path(key, '.json')
+        tmp_path = f"{result_path}.{os.getpid()}.tmp"
+        try:
+            with open(os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+                json.dump({'time': time.time(), 'result': result}, f, ensure_ascii=False)
+            os.replace(tmp_path, result_path)
+        except (OSError, TypeError, ValueError):
+            self._remove(tmp_path)
+
+    def _finish(self, key, marker, result=None, executed=False):
+        """
+        持有锁时调用：执行了调用且有其他进程在等待时写出结果；
+        没有其他等待者时删除结果和锁文件
+        """
+        self._remove(marker)
+        if self._other_waiters(key, marker):
+            if executed:
+                self._write_shared(key, result)
+        else:
+            self._remove(self._path(key, '.json'))
+            self._remove(self._path(key, '.lock'))
+
+    def _run_shared(self, key, fn):
+        """跨进程合并：按键加文件锁后执行，有其他进程刚得到的结果时直接使用"""
+        if not self.cross_process:
+            return fn()
+        marker = self._register(key)
+        try:
+            fd = self._open_locked(key, lambda fd: fcntl.flock(fd, fcntl.LOCK_EX))
+        except BaseException:
+            self._remove(marker)
+            raise
+        try:
+            shared = self._read_shared(key)
+            if shared is not None:
+                self._finish(key, marker)
+                return shared['result']
+            try:
+                result = fn()
+            except BaseException:
+                self._finish(key, marker)
+                raise
+            self._finish(key, marker, result, executed=True)
+            return result
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    async def _aopen_locked(self, key):
+        """_open_locked的异步版本，轮询非阻塞加锁，等待时被取消不会留下持有的锁"""
+        while True:
+            try:
+                return self._open_locked(key, lambda fd: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB))
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+    async def _arun_shared(self, key, coro_fn):
+        """_run_shared的异步版本，等待文件锁时不阻塞事件循环"""
+        if not self.cross_process:
+            return await coro_fn()
+        marker = self._register(key)
+        try:
+            fd = await self._aopen_locked(key)
+        except BaseException:
+            self._remove(marker)
+            raise
+        try:
+            shared = self._read_shared(key)
+            if shared is not None:
+                self._finish(key, marker)
+                return shared['result']
+            try:
+                result = await coro_fn()
+            except BaseException:
+                self._finish(key, marker)
+                raise
+            self._finish(key, marker, result, executed=True)
+            return result
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
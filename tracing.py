@@ -0,0 +1,240 @@
+"""
+合并流程各阶段和每次AI调用的轻量级跟踪
+
+用法：
+    with span('read', file=path) as s:
+        ...
+        s.set(rows=len(df))
+    current_span().add('cache_hits', 3)   # 给当前所在的span加属性
+
+通过环境变量启用（未设置时span()只返回一个共享的空对象，几乎没有开销）：
+    AIEXCEL_TRACE=trace.jsonl          每个span结束时写一行JSON
+    AIEXCEL_TRACE=trace.json           以Chrome trace格式写出（chrome://tracing 或 Perfetto 打开），进程退出时写入
+    AIEXCEL_TRACE_FORMAT=jsonl|chrome  指定格式（默认按扩展名判断）
+    AIEXCEL_PROFILE=write              对指定名称的span用cProfile分析，结果保存为profile_<名称>_<进程号>.prof
+路径中可以包含{pid}，多进程运行时各进程写入不同的文件。
+"""
+import asyncio
+import atexit
+import contextvars
+import cProfile
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_FILE = os.getenv('AIEXCEL_TRACE')
+TRACE_FORMAT = os.getenv('AIEXCEL_TRACE_FORMAT')
+PROFILE_SPAN = os.getenv('AIEXCEL_PROFILE')
+
+# 内存采样间隔（秒）
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+def current_rss():
+    """当前进程的常驻内存（字节），无法获取时（非Linux系统）返回None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def process_peak_rss():
+    """进程启动以来的常驻内存峰值（字节），无法获取时（如Windows）返回None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except (ImportError, OSError):
+        return None
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class _NoopSpan:
+    """跟踪关闭时使用的空span，所有操作都不做任何事"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        return self
+
+    def add(self, key, amount=1):
+        return self
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span = contextvars.ContextVar('aiexcel_span', default=NOOP_SPAN)
+
+def _task_id():
+    """当前协程任务（没有时为当前线程）的编号，用作Chrome trace中的tid"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+class Span:
+    """一个计时区间，记录耗时、常驻内存峰值和自定义属性"""
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.span_id = next(tracer.ids)
+        self.parent_id = None
+        self.profile = None
+
+    def set(self, **attrs):
+        """设置属性（如rows、cache='hit'）"""
+        self.attrs.update(attrs)
+        return self
+
+    def add(self, key, amount=1):
+        """累加数值属性（如token用量、缓存命中次数）"""
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+        return self
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent_id = getattr(parent, 'span_id', None)
+        self._token = _current_span.set(self)
+        self.tid = _task_id()
+        self.rss_start = self.peak_rss = current_rss()
+        self.tracer._open(self)
+        if self.name == self.tracer.profile_span:
+            self.profile = self.tracer._start_profile()
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+            self.tracer._dump_profile(self)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _current_span.reset(self._token)
+        if self.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss, current_rss())
+        self.tracer._close(self)
+        return False
+
+class Tracer:
+    """收集span并写出为JSON lines或Chrome trace格式"""
+
+    def __init__(self, path=None, fmt=None, profile_span=None):
+        self.path = path
+        self.enabled = bool(path)
+        self.format = fmt or ('chrome' if path and path.endswith('.json') else 'jsonl')
+        self.profile_span = profile_span
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.active = set()
+        self.events = []
+        self.origin = time.perf_counter()
+        self.profiling = False
+        self._sampler = None
+
+    def _output_path(self):
+        return self.path.replace('{pid}', str(os.getpid()))
+
+    def _open(self, span):
+        with self.lock:
+            self.active.add(span)
+            if self._sampler is None and span.peak_rss is not None:
+                self._sampler = threading.Thread(target=self._sample_memory, daemon=True)
+                self._sampler.start()
+
+    def _sample_memory(self):
+        """后台采样常驻内存，更新所有进行中span的峰值；没有进行中的span时退出，下一个span开始时重新启动"""
+        while True:
+            time.sleep(MEMORY_SAMPLE_INTERVAL)
+            rss = current_rss()
+            with self.lock:
+                if not self.active:
+                    self._sampler = None
+                    return
+                for span in self.active:
+                    if rss > span.peak_rss:
+                        span.peak_rss = rss
+
+    def _close(self, span):
+        record = {
+            'name': span.name,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'pid': os.getpid(),
+            'tid': span.tid,
+            'start': span.wall_start,
+            'duration': span.duration,
+        }
+        if span.peak_rss is not None:
+            record['rss_start_mb'] = round(span.rss_start / 2**20, 1)
+            record['peak_rss_mb'] = round(span.peak_rss / 2**20, 1)
+        else:
+            # 无法获取当前内存时只记录进程启动以来的峰值，不能反映该span本身的内存占用
+            peak = process_peak_rss()
+            if peak is not None:
+                record['process_peak_rss_mb'] = round(peak / 2**20, 1)
+        record.update(span.attrs)
+        with self.lock:
+            self.active.discard(span)
+            if self.format == 'chrome':
+                args = {k: v for k, v in record.items() if k not in ('name', 'pid', 'tid', 'start', 'duration')}
+                self.events.append({
+                    'name': span.name, 'cat': 'aiexcel', 'ph': 'X', 'pid': record['pid'], 'tid': span.tid,
+                    'ts': (span.start - self.origin) * 1e6, 'dur': span.duration * 1e6, 'args': args,
+                })
+            else:
+                with open(self._output_path(), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def _start_profile(self):
+        """开始cProfile分析，同一时间只分析一个span"""
+        with self.lock:
+            if self.profiling:
+                return None
+            self.profiling = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _dump_profile(self, span):
+        path = f"profile_{span.name}_{os.getpid()}.prof"
+        span.profile.dump_stats(path)
+        span.attrs['profile'] = path
+        with self.lock:
+            self.profiling = False
+
+    def flush(self):
+        """写出Chrome trace文件（JSON lines格式在每个span结束时已写出）"""
+        if not self.enabled or self.format != 'chrome':
+            return
+        with self.lock:
+            events = list(self.events)
+        with open(self._output_path(), 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False, default=str)
+
+tracer = Tracer(TRACE_FILE, TRACE_FORMAT, PROFILE_SPAN)
+atexit.register(lambda: tracer.flush())
+
+def span(name, **attrs):
+    """开始一个span（用作with语句），跟踪关闭时返回空span"""
+    if not tracer.enabled:
+        return NOOP_SPAN
+    return Span(tracer, name, attrs)
+
+def current_span():
+    """返回当前所在的span，不在任何span中或跟踪关闭时返回空span"""
+    return _current_span.get()
+
+def configure(path=None, fmt=None, profile_span=None):
+    """在代码中启用（path为None时关闭）跟踪，替换环境变量的设置"""
+    global tracer
+    tracer.flush()
+    tracer = Tracer(path, fmt, profile_span)
+    return tracer
@@ -0,0 +1,158 @@
+import json
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves are not coordinated between processes
+    fcntl = None
+
+class ValueCache:
+    def __init__(self, cache_file: str = 'value_normalization_cache.json', max_entries: int = 50000):
+        """
+        Initialize value normalization cache
+
+        Several processes may share one cache file: saves are serialized with a
+        lock file and merged with the entries other processes wrote meanwhile,
+        and lookups reload the file when another process has changed it.
+
+        Args:
+            cache_file: Path of the persistent cache file
+            max_entries: Maximum number of cached values, least recently used entries are evicted first
+        """
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.loaded_mtime = None
+        self.cache = self._load_cache()
+
+    def _file_mtime(self) -> Optional[int]:
+        """Modification time of the cache file in nanoseconds, None if it does not exist"""
+        try:
+            return os.stat(self.cache_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_cache(self) -> OrderedDict:
+        """Load cache from file, keeping the stored LRU order"""
+        try:
+            self.loaded_mtime = self._file_mtime()
+            if self.loaded_mtime is not None:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+                return OrderedDict(((namespace, raw), value) for namespace, raw, value in entries)
+            return OrderedDict()
+        except Exception as e:
+            print(f"Error loading value cache: {str(e)}")
+            return OrderedDict()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Hold an exclusive lock on the cache file across processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.cache_file}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _merge_from_disk(self) -> None:
+        """Merge entries written by other processes since the last load, keeping ours more recent"""
+        if self._file_mtime() == self.loaded_mtime:
+            return
+        merged = self._load_cache()
+        for key, value in self.cache.items():
+            merged[key] = value
+            merged.move_to_end(key)
+        self.cache = merged
+
+    def _write_cache(self) -> None:
+        """Write cache to file (written to a temporary file first, then replaced atomically)"""
+        entries = [[namespace, raw, value] for (namespace, raw), value in self.cache.items()]
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_file, self.cache_file)
+        self.loaded_mtime = self._file_mtime()
+
+    def _save_cache(self) -> None:
+        """Merge with the entries on disk and save"""
+        try:
+            with self._locked():
+                self._merge_from_disk()
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+                self._write_cache()
+        except Exception as e:
+            print(f"Error saving value cache: {str(e)}")
+
+    @staticmethod
+    def _namespace(normalizer: str, version: str) -> str:
+        """Build the namespace for a normalizer type and prompt version"""
+        return f"{normalizer}:{version}"
+
+    def get_many(self, normalizer: str, version: str, raw_values: Iterable) -> Dict:
+        """
+        Get cached normalized values
+
+        Args:
+            normalizer: Normalizer type (e.g., "date_mmdd")
+            version: Prompt version of the normalizer
+            raw_values: Raw values to look up
+
+        Returns:
+            Dictionary of raw value to normalized value, only for cached values
+        """
+        namespace = self._namespace(normalizer, version)
+        self._merge_from_disk()
+        found = {}
+        for raw in raw_values:
+            key = (namespace, str(raw))
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                found[raw] = self.cache[key]
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def get(self, normalizer: str, version: str, raw) -> Optional[str]:
+        """Get a single cached normalized value"""
+        return self.get_many(normalizer, version, [raw]).get(raw)
+
+    def save_many(self, normalizer: str, version: str, values: Dict) -> None:
+        """
+        Save normalized values to cache
+
+        Args:
+            normalizer: Normalizer type (e.g., "date_mmdd")
+            version: Prompt version of the normalizer
+            values: Dictionary of raw value to normalized value
+        """
+        if not values:
+            return
+        namespace = self._namespace(normalizer, version)
+        for raw, value in values.items():
+            key = (namespace, str(raw))
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+        self._save_cache()
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit and miss counts of this session"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+    def clear_cache(self) -> None:
+        """Clear all cache"""
+        try:
+            with self._locked():
+                self.cache = OrderedDict()
+                self._write_cache()
+        except Exception as e:
+            print(f"Error saving value cache: {str(e)}")
@@ -0,0 +1,109 @@
+import openpyxl
+import pandas as pd
+from input_cache import cached_parse
+
+def _open_sheet(file_path):
+    """以只读流式模式打开工作簿，返回工作簿和活动工作表"""
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    return wb, wb.active
+
+def _trim_row(row):
+    """去掉行末尾的空单元格"""
+    row = list(row)
+    while row and row[-1] is None:
+        row.pop()
+    return row
+
+def _make_headers(header_values, width):
+    """
+    按pandas的规则生成列名：空表头为“Unnamed: i”，重复表头追加“.1”、“.2”等后缀
+    """
+    headers = []
+    seen = {}
+    for i in range(width):
+        value = header_values[i] if i < len(header_values) else None
+        name = f"Unnamed: {i}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        headers.append(name)
+    return headers
+
+def read_headers(file_path, header_row=0, use_cache=True):
+    """
+    只读取表头，读到表头所在行即停止解析
+
+    参数：
+        file_path：Excel文件路径
+        header_row：表头所在行号（从0开始）
+        use_cache：文件没有变化时是否直接使用上次的解析结果（见input_cache）
+
+    返回：
+        表头列表
+    """
+    if use_cache:
+        headers, _ = cached_parse('headers', file_path, {'header_row': header_row},
+                                  lambda: (_parse_headers(file_path, header_row), None))
+        return headers
+    return _parse_headers(file_path, header_row)
+
+def _parse_headers(file_path, header_row):
+    wb, ws = _open_sheet(file_path)
+    try:
+        rows = ws.iter_rows(min_row=header_row + 1, max_row=header_row + 1, values_only=True)
+        header_values = _trim_row(next(rows, ()))
+    finally:
+        wb.close()
+    return _make_headers(header_values, len(header_values))
+
+def load_workbook_table(file_path, header_row=0, str_columns=None, use_cache=True):
+    """
+    一次遍历读取工作簿，同时得到标题行、表头和数据
+
+    参数：
+        file_path：Excel文件路径
+        header_row：表头所在行号（从0开始），之前的行作为标题行
+        str_columns：需要按文本读取的列名列表（如学号列）
+        use_cache：文件没有变化时是否直接使用上次的解析结果（见input_cache）
+
+    返回：
+        (title_row, headers, df)。title_row为第一行的值列表（header_row为0时为None），
+        headers为表头列表，df为表头之后的数据
+    """
+    if use_cache:
+        (title_row, headers), df = cached_parse(
+            'table', file_path, {'header_row': header_row, 'str_columns': list(str_columns or [])},
+            lambda: _split_table(_parse_workbook_table(file_path, header_row, str_columns)))
+        return title_row, headers, df
+    return _parse_workbook_table(file_path, header_row, str_columns)
+
+def _split_table(table):
+    title_row, headers, df = table
+    return (title_row, headers), df
+
+def _parse_workbook_table(file_path, header_row, str_columns):
+    wb, ws = _open_sheet(file_path)
+    try:
+        rows = ws.iter_rows(values_only=True)
+        leading = [list(next(rows, ())) for _ in range(header_row)]
+        header_values = _trim_row(next(rows, ()))
+        data = [_trim_row(row) for row in rows]
+    finally:
+        wb.close()
+
+    # 去掉末尾的空行
+    while data and not data[-1]:
+        data.pop()
+
+    width = max([len(header_values)] + [len(row) for row in data])
+    headers = _make_headers(header_values, width)
+    df = pd.DataFrame([row + [None] * (width - len(row)) for row in data], columns=headers)
+
+    for col in str_columns or []:
+        if col in df.columns:
+            df[col] = df[col].map(lambda v: v if v is None else str(v))
+
+    title_row = _trim_row(leading[0]) if leading else None
+    return title_row, headers, df